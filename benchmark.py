@@ -0,0 +1,58 @@
+import argparse
+import sys
+
+from src.params import VisionParams
+from src.orientation_finder import OrientMethod
+from src.benchmark import (
+    NUM_REFS, DATASETS, run_benchmark, save_benchmark, load_benchmark, compare_benchmarks
+)
+
+parser = argparse.ArgumentParser(description="Benchmark of the OrientationFinder.")
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+run_parser = subparsers.add_parser("run", help="Runs the benchmark and saves the report.")
+run_parser.add_argument("output", help="JSON file of the report.")
+run_parser.add_argument(
+    "--methods", nargs="+", default=[method.name for method in OrientMethod],
+    choices=[method.name for method in OrientMethod]
+)
+run_parser.add_argument("--num-refs", nargs="+", type=int, default=NUM_REFS)
+run_parser.add_argument("--datasets", nargs="+", default=list(DATASETS), choices=list(DATASETS))
+run_parser.add_argument("--split", default="test", choices=["train", "test"])
+run_parser.add_argument("--warmup", type=int, default=3)
+run_parser.add_argument("--threads", type=int, default=1)
+run_parser.add_argument("--seed", type=int, default=0)
+
+compare_parser = subparsers.add_parser(
+    "compare", help="Flags the regressions of a report against a baseline."
+)
+compare_parser.add_argument("baseline", help="JSON file of the baseline report.")
+compare_parser.add_argument("current", help="JSON file of the report to check.")
+compare_parser.add_argument("--throughput-tol", type=float, default=0.1)
+compare_parser.add_argument("--error-tol", type=float, default=0.5)
+
+args = parser.parse_args()
+
+if args.command == "run":
+    # Best parameters found by random_search.py
+    params = VisionParams(1230, 1.8847186328577767, 44, 18, 0.9827160798859101, 7)
+    report = run_benchmark(
+        params, [OrientMethod[name] for name in args.methods], args.num_refs, args.datasets,
+        args.split, args.warmup, args.threads, args.seed
+    )
+    save_benchmark(report, args.output)
+    for result in report["results"]:
+        print(
+            f"{result['dataset']} {result['method']} {result['num_refs']} refs: "
+            f"{result['time_mean']:.1f}±{result['time_std']:.1f} ms; "
+            f"{result['error_mean']:.2f}±{result['error_std']:.2f}º"
+        )
+else:
+    regressions = compare_benchmarks(
+        load_benchmark(args.baseline), load_benchmark(args.current),
+        args.throughput_tol, args.error_tol
+    )
+    for regression in regressions:
+        print(regression)
+    print(f"{len(regressions)} regressions")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,27 @@
+import argparse
+
+from src.params import VisionParams
+from src.orientation_finder import OrientMethod
+from src.tester import Tester
+
+parser = argparse.ArgumentParser(
+    description="Prunes the references of each background to their most discriminative "
+    "descriptors, scored on the train split, and saves them as reference databases."
+)
+parser.add_argument("folders", nargs="*", help="Background folders. The simulated ones if none.")
+parser.add_argument("--budget", type=int, default=600, help="Descriptors kept per reference.")
+parser.add_argument("--num-refs", type=int, default=8)
+parser.add_argument("--db-root", help="Root of the databases. Tester.compiled_db_path if not given.")
+parser.add_argument("--overwrite", action="store_true", help="Compile the existing databases again.")
+args = parser.parse_args()
+
+ref_angles = {360*i/args.num_refs for i in range(args.num_refs)}
+
+# Best parameters found by random_search.py
+params = VisionParams(1230, 1.8847186328577767, 44, 18, 0.9827160798859101, 7)
+tester = Tester(
+    params, OrientMethod.RECOVER_POSE, ref_angles, True, "test", reference_db=args.db_root,
+    descriptor_budget=args.budget
+)
+for folder in args.folders or Tester.sim_folders:
+    print(f"{folder}: {tester.compile_reference_db(folder, args.overwrite)}")
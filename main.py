@@ -6,8 +6,10 @@ import matplotlib.pyplot as plt
 import time
 
 from src.orientation_finder import OrientationFinder, OrientMethod
-from src.utils import get_angle_diff, build_intrinsic_mtx
+from src.utils import get_angle_diffs, circular_mean, circular_std, build_intrinsic_mtx
 from src.params import VisionParams
+from src.profiler import StageProfiler
+from src.query_cache import QueryFeatureCache
 
 # Camera Params
 fov = 1.012300
@@ -22,6 +24,14 @@ dataset_path = Path("./dataset/ulm/")
 
 use45s = False
 
+# Set to a path, such as "profile.json", to profile the stages of the estimation and save
+# them there. The profiler adds its own overhead to the printed times.
+profile_path = None
+
+# Set to True to cache the features of the frames. The reference images are also test images,
+# so their features are then extracted once, but the printed times are no longer a cold baseline.
+use_feature_cache = False
+
 ref_imgs = []
 ref_angles = []
 
@@ -45,27 +55,40 @@ for file in dataset_path.glob("*.png"):
 vision_params = VisionParams(5000, 1.19, 31, 50, 0.9999, 2)
 
 orientation_finder = OrientationFinder(
-    ref_imgs, ref_angles, vision_params, intrinsic_mtx
+    ref_imgs, ref_angles, vision_params, intrinsic_mtx,
+    feature_cache=QueryFeatureCache() if use_feature_cache else None
 )
-errors = []
+if profile_path is not None:
+    orientation_finder.profiler = StageProfiler()
 
 ### Comment the lines below to select the method to use
 # orient_method = OrientMethod.BEST_REF
 # orient_method = OrientMethod.WEIGHT_AVG
 orient_method = OrientMethod.RECOVER_POSE
+# orient_method = OrientMethod.YAW_RANSAC
+# orient_method = OrientMethod.PANORAMA
 
 times = []
+estimated_angles = []
 for i in range(len(imgs)):
-    start_time = time.time()
-    errors.append(abs(get_angle_diff(angles[i],  orientation_finder.calc_orientation(imgs[i], orient_method))))
-    end_time = time.time()
+    start_time = time.perf_counter()
+    estimated_angles.append(orientation_finder.calc_orientation(imgs[i], orient_method))
+    end_time = time.perf_counter()
     times.append(end_time - start_time)
+signed_errors = get_angle_diffs(angles, estimated_angles)
+errors = np.abs(signed_errors)
 
 times = 1000*np.array(times) # Converting to ms
 
 print(f"Execution Time: {times.mean():.0f}±{times.std():.0f} ms per iteration")
 print ("Mean: %.2f degrees" % np.array(errors).mean())
 print ("Std Dev: %.2f degrees" % np.array(errors).std())    
+print ("Circular bias: %.2f±%.2f degrees" % (circular_mean(signed_errors), circular_std(signed_errors)))
+if use_feature_cache:
+    print(f"Feature cache: {orientation_finder.feature_cache.stats()}")
+if profile_path is not None:
+    print(orientation_finder.profiler)
+    orientation_finder.profiler.to_json(profile_path)
 
 plt.hist(errors, bins=np.linspace(0, 50, 25), histtype='bar', ec='black')
 plt.title('Error Histogram')
@@ -1,12 +1,18 @@
 from src.params import VisionParams
 from src.tester import Tester
 from src.orientation_finder import OrientMethod
+from src.dataset import DatasetCache
+from src.query_cache import QueryFeatureCache
 
 def method_str(method:OrientMethod):
     if method == OrientMethod.RECOVER_POSE:
         return "recoverpose"
     if method == OrientMethod.BEST_REF:
         return "bestref"
+    if method == OrientMethod.YAW_RANSAC:
+        return "yawransac"
+    if method == OrientMethod.PANORAMA:
+        return "panorama"
 
 num_refs = [1, 2, 3, 4, 6, 8, 12, 24]
 
@@ -19,12 +25,21 @@ errors_std = []
 # method = OrientMethod.BEST_REF
 method = OrientMethod.RECOVER_POSE
 
+# Match all references with a single query on one merged index
+merged_index = False
+
 params = VisionParams.default()
 
+# The images are decoded once into the dataset cache and memory-mapped by every Tester
+dataset = DatasetCache(Tester.dataset_cache_path, Tester.sim_folders, Tester.dataset_path)
+# Only the references change between runs, so the test frames are extracted once
+feature_cache = QueryFeatureCache(path=Tester.feature_cache_path)
+
 for num_ref in num_refs:
     ref_angles = {360*i/num_ref for i in range(num_ref)}
     time_mean, time_std, error_mean, error_std = Tester(
-        params, method, ref_angles, True, "test"
+        params, method, ref_angles, True, "test", merged_index, dataset=dataset,
+        feature_cache=feature_cache
     ).performance()
     times_mean.append(time_mean)
     times_std.append(time_std)
@@ -44,3 +59,4 @@ with open(f"errors_std_{method_str(method)}.txt", "w") as f:
 
 for i, num_ref in enumerate(num_refs):
     print(f"{num_ref} refs: {times_mean[i]}±{times_std[i]} ms; {errors_mean[i]}±{errors_std[i]}º")
+print(f"Feature cache: {feature_cache.stats()}")
@@ -1,28 +1,40 @@
 import time
-from math import inf
 
-from src.params import VisionParams
 from src.orientation_finder import OrientMethod
-from src.utils import cost
+from src.search import ParamSearch
+from src.tuner import SuccessiveHalving
 from src.tester import Tester
 
-min_cost = inf
 num_iter = 150
 num_refs = 8
 ref_angles = {360*i/num_refs for i in range(num_refs)}
 
+# Also search the detector (ORB, AKAZE, BRISK) and matcher (LSH, BF) backends
+tune_backends = False
+
+# Successive halving starts with many more candidates, but scores them on
+# subsets of the dataset and only fully evaluates the most promising ones
+use_successive_halving = False
+num_candidates = 1000
+eta = 3
+num_rungs = 4
+
+# Evaluated candidates, and those of each rung of the successive halving, are logged,
+# so running the search again resumes it
+search_class = SuccessiveHalving if use_successive_halving else ParamSearch
+search = search_class(
+    OrientMethod.RECOVER_POSE, ref_angles, "train", log_path="random_search_log.jsonl",
+    tune_backends=tune_backends, dataset_cache=Tester.dataset_cache_path
+)
+
 start_time = time.time()
-for i in range(num_iter):
-    params = VisionParams.construct_random()
-    time_mean, time_std, error_mean, error_std = Tester(
-        params, OrientMethod.RECOVER_POSE, ref_angles, True, "train"
-    ).performance()
-    iter_cost = cost(time_mean, time_std, error_mean, error_std)
-    if iter_cost < min_cost:
-        min_cost = iter_cost
-        with open("best_random_params.txt", "w") as params_file:
-            params_file.write(f"{params}\n")
-            params_file.write(f"Time:  {time_mean:.0f}±{time_std:.0f} ms\n")
-            params_file.write(f"Error: {error_mean:.2f}±{error_std:.2f} º\n")
+if use_successive_halving:
+    best = search.run(num_candidates, eta, num_rungs)
+else:
+    best = search.run(num_iter)
+with open("best_random_params.txt", "w") as params_file:
+    params_file.write(f"{best.params}\n")
+    params_file.write(f"Time:  {best.time_mean:.0f}±{best.time_std:.0f} ms\n")
+    params_file.write(f"Error: {best.error_mean:.2f}±{best.error_std:.2f} º\n")
 end_time = time.time()
-print(f"{num_iter} iterations in {end_time - start_time} seconds.")
+print(f"{search_class.__name__} in {end_time - start_time} seconds.")
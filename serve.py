@@ -0,0 +1,44 @@
+import argparse
+import asyncio
+
+import cv2
+
+from src.params import VisionParams
+from src.orientation_finder import OrientationFinder, OrientMethod
+from src.dataset import parse_file_name
+from src.tester import Tester
+from src.service import OrientationService
+
+parser = argparse.ArgumentParser(description="Serves the orientation of the frames of a venue.")
+parser.add_argument("venue", help="Background folder of the dataset with the reference images.")
+parser.add_argument("--socket", help="Path of the Unix socket. If not given, TCP is used.")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8765)
+parser.add_argument(
+    "--method", default=OrientMethod.RECOVER_POSE.name, choices=[method.name for method in OrientMethod]
+)
+parser.add_argument("--num-refs", type=int, default=8)
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--batch-window", type=float, default=0.005, help="In seconds.")
+parser.add_argument("--workers", type=int, default=None)
+parser.add_argument("--max-pending", type=int, default=4)
+args = parser.parse_args()
+
+ref_angles = {360*i/args.num_refs for i in range(args.num_refs)}
+ref_imgs = []
+angles = []
+for file in sorted((Tester.dataset_path / args.venue).glob("ref_*.png")):
+    _, img_angle, _ = parse_file_name(file)
+    if img_angle in ref_angles:
+        ref_imgs.append(cv2.imread(str(file), cv2.IMREAD_ANYCOLOR))
+        angles.append(img_angle)
+
+# Best parameters found by random_search.py
+params = VisionParams(1230, 1.8847186328577767, 44, 18, 0.9827160798859101, 7)
+orientation_finder = OrientationFinder(ref_imgs, angles, params, Tester.intrinsic_mtx)
+service = OrientationService(
+    orientation_finder, OrientMethod[args.method], args.batch_size, args.batch_window,
+    args.workers, args.max_pending
+)
+print(f"Serving {args.venue} with {len(angles)} references on {args.socket or f'{args.host}:{args.port}'}")
+asyncio.run(service.serve_forever(args.socket, args.host, args.port))
@@ -0,0 +1,104 @@
+import numpy as np
+import cv2
+
+from src.params import VisionParams
+
+
+class CappedDetector:
+    """
+    Wraps a detector without a maximum number of features, such as AKAZE or BRISK,
+    keeping only the nfeatures keypoints with the strongest response.
+    """
+
+    def __init__(self, detector, nfeatures:int) -> None:
+        self.detector = detector
+        self.nfeatures = nfeatures
+
+    def detectAndCompute(self, img, mask):
+        points, descriptors = self.detector.detectAndCompute(img, mask)
+        if len(points) <= self.nfeatures:
+            return points, descriptors
+        responses = np.array([point.response for point in points])
+        best = np.sort(np.argsort(-responses, kind='stable')[:self.nfeatures])
+        return tuple(points[i] for i in best), descriptors[best]
+
+
+def create_detector(params:VisionParams):
+    """
+    Creates the feature detector set in the vision parameters.
+    All of them compute binary descriptors, matched with the Hamming distance.
+    :param params: Vision parameters.
+    :return: Object with a detectAndCompute method, like cv2.Feature2D.
+    """
+    if params.detector == "ORB":
+        return cv2.ORB_create(
+            nfeatures=params.nfeatures, scaleFactor=params.scaleFactor,
+            patchSize=params.patchSize, edgeThreshold=params.patchSize
+        )
+    if params.detector == "AKAZE":
+        return CappedDetector(cv2.AKAZE_create(threshold=params.akaze_threshold), params.nfeatures)
+    if params.detector == "BRISK":
+        return CappedDetector(cv2.BRISK_create(thresh=params.brisk_threshold), params.nfeatures)
+    raise ValueError(f"Unknown detector {params.detector}")
+
+
+class LshIndex:
+    """
+    Approximate Hamming nearest neighbours with FLANN's LSH tables.
+    """
+
+    def __init__(self, descriptors, params:VisionParams) -> None:
+        self.index = cv2.flann_Index(descriptors, {
+            'algorithm':6, 'table_number':params.table_number,
+            'key_size':params.key_size, 'multi_probe_level':params.multi_probe_level
+        })
+        self.search_params = {'checks': params.checks}
+
+    def knn_search(self, query, k:int):
+        """
+        :param query: Query descriptors.
+        :param k: Number of neighbours.
+        :return: Indices and distances of the neighbours, np.arrays of shape (N, k).
+        Missing neighbours have index -1.
+        """
+        return self.index.knnSearch(query, k, params=self.search_params)
+
+
+class BruteForceIndex:
+    """
+    Exact Hamming nearest neighbours, comparing the packed descriptors with every train descriptor.
+    For a few small references it is often faster than building and probing LSH tables.
+    """
+
+    def __init__(self, descriptors, params:VisionParams) -> None:
+        self.descriptors = descriptors
+
+    def knn_search(self, query, k:int):
+        """
+        :param query: Query descriptors.
+        :param k: Number of neighbours.
+        :return: Indices and distances of the neighbours, np.arrays of shape (N, k).
+        Missing neighbours have index -1.
+        """
+        found = min(k, len(self.descriptors))
+        distances, indices = cv2.batchDistance(
+            query, self.descriptors, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=found
+        )
+        if found < k:
+            indices = np.pad(indices, ((0, 0), (0, k - found)), constant_values=-1)
+            distances = np.pad(distances, ((0, 0), (0, k - found)), constant_values=-1)
+        return indices, distances
+
+
+def create_index(descriptors, params:VisionParams):
+    """
+    Builds the nearest neighbours index set in the vision parameters.
+    :param descriptors: Train descriptors.
+    :param params: Vision parameters.
+    :return: Index with a knn_search method.
+    """
+    if params.matcher == "LSH":
+        return LshIndex(descriptors, params)
+    if params.matcher == "BF":
+        return BruteForceIndex(descriptors, params)
+    raise ValueError(f"Unknown matcher {params.matcher}")
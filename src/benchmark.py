@@ -0,0 +1,150 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+
+import numpy as np
+import cv2
+
+from src.params import VisionParams
+from src.orientation_finder import OrientMethod
+from src.tester import Tester
+
+NUM_REFS = [1, 2, 3, 4, 6, 8, 12, 24]
+DATASETS = {"sim": True, "irl": False}
+
+
+def environment() -> dict:
+    """
+    Returns the metadata of the environment the benchmark runs on.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "cv2_threads": cv2.getNumThreads(),
+        "git_commit": commit,
+    }
+
+
+def run_benchmark(
+    params:VisionParams, methods=tuple(OrientMethod), num_refs=NUM_REFS, datasets=tuple(DATASETS),
+    split:str="test", num_warmup:int=3, num_threads:int=1, seed:int=0
+) -> dict:
+    """
+    Benchmarks every combination of dataset, method and number of references.
+    OpenCV, NumPy and Python are seeded and OpenCV uses a fixed number of threads.
+    The LSH tables are drawn by FLANN itself, so matches can still vary slightly.
+    :param params: Vision parameters.
+    :param methods: Methods to benchmark.
+    :param num_refs: Numbers of references, evenly spaced in angle.
+    :param datasets: Names of the datasets, "sim" and/or "irl".
+    :param split: "train" or "test".
+    :param num_warmup: Number of untimed images run before each folder.
+    :param num_threads: Number of threads used by OpenCV.
+    :param seed: Seed of the random number generators.
+    :return: Dict with the environment, the configuration and the results.
+    """
+    cv2.setNumThreads(num_threads)
+    cv2.setRNGSeed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    results = []
+    start_time = time.perf_counter()
+    for dataset in datasets:
+        for method in methods:
+            for num_ref in num_refs:
+                ref_angles = {360*i/num_ref for i in range(num_ref)}
+                tester = Tester(
+                    params, method, ref_angles, DATASETS[dataset], split, num_warmup=num_warmup
+                )
+                tester.performance()
+                results.append({
+                    "dataset": dataset,
+                    "method": method.name,
+                    "num_refs": num_ref,
+                    "num_imgs": len(tester.times),
+                    "num_fails": len(tester.fails),
+                    "time_mean": tester.times.mean(),
+                    "time_std": tester.times.std(),
+                    "time_p50": np.percentile(tester.times, 50),
+                    "time_p95": np.percentile(tester.times, 95),
+                    "throughput": 1000/tester.times.mean(),
+                    "error_mean": tester.errors.mean(),
+                    "error_std": tester.errors.std(),
+                    "error_p50": np.percentile(tester.errors, 50),
+                })
+    return {
+        "environment": environment(),
+        "config": {
+            "params": params.as_dict(), "split": split, "num_warmup": num_warmup,
+            "num_threads": num_threads, "seed": seed,
+            "total_time": time.perf_counter() - start_time,
+        },
+        "results": [
+            {key: value.item() if isinstance(value, np.generic) else value for key, value in result.items()}
+            for result in results
+        ],
+    }
+
+
+def save_benchmark(report:dict, path):
+    """
+    Saves a benchmark report as JSON.
+    """
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_benchmark(path) -> dict:
+    """
+    Loads a benchmark report saved by save_benchmark.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_benchmarks(baseline:dict, current:dict, throughput_tol:float=0.1, error_tol:float=0.5):
+    """
+    Compares two benchmark reports, case by case.
+    :param baseline: Report used as reference.
+    :param current: Report to be checked.
+    :param throughput_tol: Maximum relative drop of throughput.
+    :param error_tol: Maximum increase of the mean error, in degrees.
+    :return: List of messages, one per regression. Empty if there is none.
+    """
+    def key(result):
+        return result["dataset"], result["method"], result["num_refs"]
+
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = baseline_results.get(key(result))
+        if base is None:
+            continue
+        name = "{} {} {} refs".format(*key(result))
+        if result["throughput"] < (1 - throughput_tol)*base["throughput"]:
+            regressions.append(
+                f"{name}: throughput {result['throughput']:.1f} fps, baseline {base['throughput']:.1f} fps"
+            )
+        if result["error_mean"] > base["error_mean"] + error_tol:
+            regressions.append(
+                f"{name}: error {result['error_mean']:.2f}º, baseline {base['error_mean']:.2f}º"
+            )
+        if result["num_fails"] > base["num_fails"]:
+            regressions.append(
+                f"{name}: {result['num_fails']} fails, baseline {base['num_fails']}"
+            )
+    return regressions
@@ -0,0 +1,222 @@
+from multiprocessing import shared_memory
+import json
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+
+def parse_file_name(file):
+    """
+    Parses the name of a dataset image, such as ref_45_train.png.
+    :param file: Path of the image.
+    :return: Case, angle in degrees and train/test split of the image.
+    """
+    img_case, img_angle, img_test_train = Path(file).stem.split("_")
+    return img_case, int(img_angle), img_test_train
+
+
+class IndexedDataset:
+    """
+    Decoded dataset images with their metadata as arrays, selected by index.
+    Subclasses set the backgrounds, cases, angles and splits arrays and implement image.
+    """
+
+    def image(self, index:int):
+        """
+        Returns an image, without copying it.
+        :param index: Index of the image.
+        """
+        raise NotImplementedError
+
+    def select(self, folder, case=None, ref_angles=None, split=None):
+        """
+        Returns the indices of the images that match all the given filters.
+        :param folder: Background folder.
+        :param case: Image case, such as "ref". Any case if None.
+        :param ref_angles: Set with the allowed angles. Any angle if None.
+        :param split: "train" or "test". Any split if None.
+        :return: np.array with the image indices.
+        """
+        mask = self.backgrounds == folder
+        if case is not None:
+            mask &= self.cases == case
+        if ref_angles is not None:
+            mask &= np.isin(self.angles, list(ref_angles))
+        if split is not None:
+            mask &= self.splits == split
+        return np.flatnonzero(mask)
+
+
+class SharedDataset(IndexedDataset):
+    """
+    Dataset images decoded once and stored in a single shared memory block.
+    Pickling it only sends the name of the block and the metadata,
+    so worker processes attach to the images without copying or decoding them.
+    """
+
+    def __init__(self, dataset_path, folders) -> None:
+        """
+        Decodes the images of the folders into shared memory.
+        :param dataset_path: Root folder of the dataset.
+        :param folders: Names of the background folders to load.
+        """
+        files = [
+            file for folder in folders
+            for file in sorted((Path(dataset_path) / folder).glob("*.png"))
+        ]
+        first_img = cv2.imread(str(files[0]), cv2.IMREAD_ANYCOLOR)
+        shape = (len(files), *first_img.shape)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.owner = True
+        self.imgs = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+        for i, file in enumerate(files):
+            self.imgs[i] = cv2.imread(str(file), cv2.IMREAD_ANYCOLOR)
+
+        metadata = [parse_file_name(file) for file in files]
+        self.backgrounds = np.array([file.parent.name for file in files])
+        self.cases = np.array([case for case, _, _ in metadata])
+        self.angles = np.array([angle for _, angle, _ in metadata])
+        self.splits = np.array([split for _, _, split in metadata])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["shm"], state["imgs"]
+        state["shm_name"] = self.shm.name
+        state["shape"] = self.imgs.shape
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop("shm_name")
+        shape = state.pop("shape")
+        self.__dict__.update(state)
+        # Worker processes share the resource tracker of their parent,
+        # so attaching does not register the block a second time
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.owner = False
+        self.imgs = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    def image(self, index:int):
+        return self.imgs[index]
+
+    def close(self):
+        """
+        Releases the shared memory. The process that created it also frees the block.
+        """
+        del self.imgs
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Version of the on-disk layout of the dataset cache, bumped whenever it changes
+CACHE_FORMAT = 1
+CACHE_MANIFEST = "manifest.json"
+
+
+def build_dataset_cache(dataset_path, cache_path, folders):
+    """
+    Decodes the images of the folders into the dataset cache, one contiguous
+    uint8 array per folder, adding them to the folders already in the cache.
+    :param dataset_path: Root folder of the dataset.
+    :param cache_path: Folder of the cache.
+    :param folders: Names of the background folders to convert.
+    """
+    cache_path = Path(cache_path)
+    cache_path.mkdir(parents=True, exist_ok=True)
+    manifest_path = cache_path / CACHE_MANIFEST
+    manifest = {"format": CACHE_FORMAT, "folders": {}}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        assert manifest["format"] == CACHE_FORMAT
+
+    for folder in folders:
+        files = sorted((Path(dataset_path) / folder).glob("*.png"))
+        first_img = cv2.imread(str(files[0]), cv2.IMREAD_ANYCOLOR)
+        imgs = np.lib.format.open_memmap(
+            cache_path / f"{folder}.npy", mode="w+", dtype=np.uint8,
+            shape=(len(files), *first_img.shape)
+        )
+        for i, file in enumerate(files):
+            imgs[i] = cv2.imread(str(file), cv2.IMREAD_ANYCOLOR)
+        imgs.flush()
+        del imgs
+        metadata = [parse_file_name(file) for file in files]
+        manifest["folders"][folder] = {
+            "files": [file.name for file in files],
+            "cases": [case for case, _, _ in metadata],
+            "angles": [angle for _, angle, _ in metadata],
+            "splits": [split for _, _, split in metadata],
+        }
+    # Written last, so an interrupted conversion is not mistaken for a complete one
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+
+class DatasetCache(IndexedDataset):
+    """
+    Dataset images pre-decoded on disk by build_dataset_cache and memory-mapped,
+    so loading them costs no decoding and only the pages read are brought to memory.
+    Pickling it only sends the path of the cache, so worker processes map the same files.
+    Delete the cache folder to rebuild it after the dataset changes.
+    """
+
+    def __init__(self, cache_path, folders, dataset_path=None) -> None:
+        """
+        :param cache_path: Folder of the cache.
+        :param folders: Names of the background folders to load.
+        :param dataset_path: Root folder of the dataset. If given, the folders
+        missing from the cache are converted first.
+        """
+        self.cache_path = Path(cache_path)
+        self.folders = list(folders)
+        if dataset_path is not None:
+            missing = [folder for folder in self.folders if folder not in self.cached_folders()]
+            if missing:
+                build_dataset_cache(dataset_path, self.cache_path, missing)
+        self.load()
+
+    def cached_folders(self) -> dict:
+        """
+        Returns the metadata of the folders in the cache, by folder name.
+        """
+        manifest_path = self.cache_path / CACHE_MANIFEST
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return manifest["folders"] if manifest["format"] == CACHE_FORMAT else {}
+
+    def load(self):
+        """
+        Memory-maps the images of the folders and gathers their metadata.
+        """
+        cached_folders = self.cached_folders()
+        metadata = [cached_folders[folder] for folder in self.folders]
+        self.folder_imgs = [
+            np.load(self.cache_path / f"{folder}.npy", mmap_mode="r") for folder in self.folders
+        ]
+        self.offsets = np.concatenate(([0], np.cumsum([len(imgs) for imgs in self.folder_imgs])))
+        self.backgrounds = np.repeat(self.folders, [len(imgs) for imgs in self.folder_imgs])
+        self.cases = np.concatenate([folder["cases"] for folder in metadata])
+        self.angles = np.concatenate([folder["angles"] for folder in metadata])
+        self.splits = np.concatenate([folder["splits"] for folder in metadata])
+
+    def __getstate__(self):
+        return {"cache_path": self.cache_path, "folders": self.folders}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+    def image(self, index:int):
+        folder_idx = np.searchsorted(self.offsets, index, side="right") - 1
+        return self.folder_imgs[folder_idx][index - self.offsets[folder_idx]]
+
+    def close(self):
+        """
+        Unmaps the images.
+        """
+        del self.folder_imgs
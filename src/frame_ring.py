@@ -0,0 +1,275 @@
+from multiprocessing import resource_tracker, shared_memory
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+
+import numpy as np
+import cv2
+
+# The buffer starts with a header of int64: the number of frames written, the capacity,
+# the number of dimensions and the frame shape (up to 3 dimensions), followed by the
+# sequence number of the frame in each slot and then by the frames themselves.
+HEADER_SIZE = 6
+# Sequence number of a slot that is being written
+WRITING = -1
+
+
+def _set_tracked(shm:shared_memory.SharedMemory, tracked:bool):
+    """
+    Registers or unregisters a shared memory block with the resource tracker of this process,
+    which unlinks the blocks still registered when the process exits.
+    Before Python 3.13, every process that attaches to a block registers it, even if it did
+    not create it, so a consumer exiting would free the block of the producer.
+    Only POSIX systems track shared memory, under the name with a leading slash.
+    """
+    if os.name != "posix":
+        return
+    name = "/" + shm.name
+    if tracked:
+        resource_tracker.register(name, "shared_memory")
+    else:
+        resource_tracker.unregister(name, "shared_memory")
+
+
+class FrameRing:
+    """
+    Ring buffer of raw uint8 frames in shared memory or in a memory-mapped file.
+    The producer, usually the camera driver, writes each frame into the next slot,
+    and the consumers get the frames as NumPy views of the buffer, without decoding
+    or copying them. The views are only valid until the producer wraps around,
+    which is_valid tells after the frame is processed.
+    """
+
+    def __init__(self, buffer, shape=None, capacity:int=None, owner:bool=False, close=None) -> None:
+        """
+        Wraps an existing buffer. Use the create_* and open_* class methods instead.
+        :param buffer: Writable buffer with the layout of the ring.
+        :param shape: Frame shape, to initialize a new ring. If None, it is read from the header.
+        :param capacity: Number of slots, to initialize a new ring.
+        :param owner: If True, closing the ring also frees the buffer.
+        :param close: Function without arguments that releases the buffer.
+        """
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=buffer)
+        if shape is not None:
+            assert capacity >= 2
+            assert 2 <= len(shape) <= 3
+            self.header[:] = 0
+            self.header[1] = capacity
+            self.header[2] = len(shape)
+            self.header[3:3 + len(shape)] = shape
+        capacity = int(self.header[1])
+        self.shape = tuple(int(size) for size in self.header[3:3 + int(self.header[2])])
+        self.capacity = capacity
+        self.sequence = np.ndarray(
+            (capacity,), dtype=np.int64, buffer=buffer, offset=self.header.nbytes
+        )
+        if shape is not None:
+            self.sequence[:] = WRITING
+        self.frames = np.ndarray(
+            (capacity, *self.shape), dtype=np.uint8, buffer=buffer,
+            offset=self.header.nbytes + self.sequence.nbytes
+        )
+        self.owner = owner
+        self.release = close
+
+    @staticmethod
+    def nbytes(shape, capacity:int) -> int:
+        """
+        Returns the size of the buffer of a ring.
+        """
+        return 8*(HEADER_SIZE + capacity) + capacity*int(np.prod(shape))
+
+    @classmethod
+    def create_shared(cls, shape, capacity:int, name=None):
+        """
+        Creates a ring in a new shared memory block.
+        :param shape: Frame shape, (height, width) or (height, width, channels).
+        :param capacity: Number of slots.
+        :param name: Name of the block. If None, a random name is used.
+        :return: FrameRing. Its name attribute is the name of the block.
+        """
+        shm = shared_memory.SharedMemory(name, create=True, size=cls.nbytes(shape, capacity))
+        ring = cls(shm.buf, shape, capacity, owner=True, close=shm.close)
+        ring.shm = shm
+        ring.name = shm.name
+        return ring
+
+    @classmethod
+    def open_shared(cls, name:str):
+        """
+        Attaches to a ring in an existing shared memory block.
+        """
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name)
+            _set_tracked(shm, False)
+        ring = cls(shm.buf, close=shm.close)
+        ring.shm = shm
+        ring.name = name
+        return ring
+
+    @classmethod
+    def create_file(cls, path, shape, capacity:int):
+        """
+        Creates a ring in a memory-mapped file, overwriting it if it exists.
+        :param path: Path of the file.
+        :param shape: Frame shape, (height, width) or (height, width, channels).
+        :param capacity: Number of slots.
+        """
+        buffer = np.memmap(path, dtype=np.uint8, mode="w+", shape=(cls.nbytes(shape, capacity),))
+        return cls(buffer, shape, capacity, close=buffer.flush)
+
+    @classmethod
+    def open_file(cls, path):
+        """
+        Opens a ring in an existing memory-mapped file.
+        """
+        buffer = np.memmap(path, dtype=np.uint8, mode="r+")
+        return cls(buffer, close=buffer.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Releases the buffer. The views of the frames must not be used afterwards.
+        The process that created a shared memory ring also frees the block.
+        """
+        del self.header, self.sequence, self.frames
+        self.release()
+        if self.owner:
+            if sys.version_info < (3, 13):
+                # A consumer in this process shares its resource tracker and untracked the block
+                _set_tracked(self.shm, True)
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                # Already freed by another process, only the tracker still knows of it
+                _set_tracked(self.shm, False)
+
+    @property
+    def num_written(self) -> int:
+        """
+        Number of frames written so far. The last frame has this number minus one.
+        """
+        return int(self.header[0])
+
+    def write(self, img) -> int:
+        """
+        Copies a frame into the next slot. Only one producer may write to a ring.
+        :param img: Frame with the shape of the ring.
+        :return: Sequence number of the frame.
+        """
+        frame_id = int(self.header[0])
+        slot = frame_id%self.capacity
+        self.sequence[slot] = WRITING
+        self.frames[slot] = img
+        self.sequence[slot] = frame_id
+        self.header[0] = frame_id + 1
+        return frame_id
+
+    def is_valid(self, frame_id:int) -> bool:
+        """
+        Tells whether a frame is still in the ring, untouched by the producer.
+        """
+        return int(self.sequence[frame_id%self.capacity]) == frame_id
+
+    def read(self, frame_id:int):
+        """
+        Returns a view of a frame, without copying it.
+        :param frame_id: Sequence number of the frame.
+        :return: np.array view of the frame, or None if it is not in the ring.
+        """
+        if not self.is_valid(frame_id):
+            return None
+        return self.frames[frame_id%self.capacity]
+
+    def latest(self):
+        """
+        Returns the most recent frame.
+        :return: Sequence number and view of the frame, or None and None if there is none.
+        """
+        frame_id = self.num_written - 1
+        img = self.read(frame_id) if frame_id >= 0 else None
+        return (frame_id, img) if img is not None else (None, None)
+
+    def wait_next(self, frame_id:int, timeout=None, poll_interval:float=1e-3):
+        """
+        Waits for the frames after a given one and returns the most recent, skipping
+        the others, so a slow consumer always processes the freshest frame.
+        :param frame_id: Sequence number of the last frame processed. -1 for any frame.
+        :param timeout: Maximum time to wait, in seconds. Forever if None.
+        :param poll_interval: Time between checks of the ring, in seconds.
+        :return: Sequence number and view of the frame, or None and None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.num_written - 1 > frame_id:
+                next_id, img = self.latest()
+                if img is not None:
+                    return next_id, img
+            if deadline is not None and time.monotonic() >= deadline:
+                return None, None
+            time.sleep(poll_interval)
+
+
+class FileFrameProducer:
+    """
+    Stand-in for the camera driver: writes image files into a FrameRing at a fixed rate.
+    The files are decoded once beforehand, so writing a frame is a single copy.
+    """
+
+    def __init__(self, ring:FrameRing, files, fps=None, loop:bool=False) -> None:
+        """
+        :param ring: Ring in which the frames are written.
+        :param files: Paths of the images, with the frame shape of the ring.
+        :param fps: Frames written per second. As fast as possible if None.
+        :param loop: If True, the files are written over and over until stopped.
+        """
+        self.ring = ring
+        self.imgs = []
+        flags = cv2.IMREAD_COLOR if len(ring.shape) == 3 else cv2.IMREAD_GRAYSCALE
+        for file in files:
+            img = cv2.imread(str(Path(file)), flags)
+            assert img is not None and img.shape == ring.shape, f"Unexpected frame: {file}"
+            self.imgs.append(img)
+        self.fps = fps
+        self.loop = loop
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        """
+        Writes the frames, blocking until all are written or until stopped.
+        """
+        period = None if self.fps is None else 1/self.fps
+        next_time = time.monotonic()
+        while not self.stopped.is_set():
+            for img in self.imgs:
+                if self.stopped.is_set():
+                    return
+                if period is not None:
+                    time.sleep(max(0., next_time - time.monotonic()))
+                    next_time += period
+                self.ring.write(img)
+            if not self.loop:
+                return
+
+    def start(self):
+        """
+        Writes the frames in a background thread.
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
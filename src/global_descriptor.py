@@ -0,0 +1,65 @@
+import numpy as np
+import cv2
+
+
+class BinaryVocabulary:
+    """
+    Bag of binary words over ORB descriptors.
+    Each image is summarized by the normalized histogram of the words
+    nearest to its descriptors, a compact global signature that is much
+    cheaper to compare than matching all the descriptors.
+    """
+
+    def __init__(self, descriptors, num_words:int=64, num_iter:int=5, seed:int=0) -> None:
+        """
+        Builds the vocabulary with k-majority clustering, the binary version of k-means.
+        :param descriptors: Binary descriptors used to train the vocabulary, as uint8 np.array.
+        :param num_words: Number of words.
+        :param num_iter: Number of clustering iterations.
+        :param seed: Seed of the initial words.
+        """
+        descriptors = np.ascontiguousarray(descriptors)
+        rng = np.random.default_rng(seed)
+        num_words = min(num_words, len(descriptors))
+        self.words = descriptors[rng.choice(len(descriptors), num_words, replace=False)]
+        bits = np.unpackbits(descriptors, axis=1)
+        for _ in range(num_iter):
+            assignment = self.assign(descriptors)
+            counts = np.bincount(assignment, minlength=num_words)
+            bit_counts = np.zeros((num_words, bits.shape[1]), dtype=np.int64)
+            np.add.at(bit_counts, assignment, bits)
+            # Each bit of a word is the majority among its descriptors. Empty words are kept.
+            majority = np.packbits(2*bit_counts > counts[:, None], axis=1)
+            self.words = np.where(counts[:, None] > 0, majority, self.words)
+
+    def assign(self, descriptors):
+        """
+        Returns the nearest word of each descriptor in Hamming distance.
+        :param descriptors: Binary descriptors, as uint8 np.array.
+        :return: np.array with the index of the word of each descriptor.
+        """
+        _, nearest = cv2.batchDistance(
+            descriptors, self.words, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=1
+        )
+        return nearest.ravel()
+
+    def signature(self, descriptors):
+        """
+        Returns the global signature of an image.
+        :param descriptors: Binary descriptors of the image, as uint8 np.array.
+        :return: L1 normalized histogram of the words, as float32 np.array.
+        """
+        histogram = np.bincount(
+            self.assign(descriptors), minlength=len(self.words)
+        ).astype(np.float32)
+        return histogram/max(histogram.sum(), 1.)
+
+    @staticmethod
+    def distances(signature, signatures):
+        """
+        Returns the L1 distances between a signature and many others.
+        :param signature: Signature of shape (num_words,).
+        :param signatures: Signatures of shape (N, num_words).
+        :return: np.array with N distances.
+        """
+        return np.abs(signatures - signature).sum(axis=1)
@@ -1,17 +1,58 @@
 from collections import namedtuple
-from functools import reduce
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from enum import Enum
+from itertools import repeat
+import sys
+import threading
+import time
+import warnings
 
 import numpy as np
 import cv2
 
-from src.utils import get_angle_diff, weighted_avg, calc_euler_angles
+from src.utils import get_angle_diff, weighted_avg, calc_euler_angles, calc_bearing_angles
 from src.params import VisionParams
+from src.global_descriptor import BinaryVocabulary
+from src.backends import create_detector, create_index
+from src.panorama import Panorama
+from src.query_cache import image_hash, extraction_key
+from src.profiler import StageProfiler
 
 class OrientMethod(Enum):
     BEST_REF = 0
     WEIGHT_AVG = 1
     RECOVER_POSE = 2
+    YAW_RANSAC = 3
+    PANORAMA = 4
+
+class OrientPath(Enum):
+    # Heading of the best reference
+    REFERENCE = 0
+    # Weighted average of the best references' angles
+    WEIGHT_AVG = 1
+    # recoverPose with USAC_ACCURATE
+    RECOVER_POSE = 2
+    # recoverPose with USAC_FAST, when the best reference leads by a large margin
+    FAST_POSE = 3
+    # recoverPose failed and the heading of the best reference was used
+    POSE_FALLBACK = 4
+    # Rotation about the vertical axis only, fitted with RANSAC
+    YAW_RANSAC = 5
+    # Bearings of the panorama keypoints, fitted with RANSAC
+    PANORAMA = 6
+
+# Result of one image of a batch. Angle is None and error is set when it fails.
+BatchResult = namedtuple('BatchResult', ['angle', 'error'])
+
+# Orientation of an image along with how it was found.
+# num_matches is the match count of the best reference and margin its lead over the runner-up.
+# With the panorama, num_matches counts the panorama matches and margin is None.
+# inlier_ratio is the fraction of those matches kept by the pose fit, None when it is not run.
+# early_exit tells whether matching stopped before all references were scored.
+OrientationResult = namedtuple(
+    'OrientationResult', ['heading', 'num_matches', 'margin', 'inlier_ratio', 'path', 'early_exit']
+)
 
 class OrientationFinder:
     """
@@ -20,33 +61,566 @@ class OrientationFinder:
     to a new image to estimate the orientation in which the image.
     was taken.
     """    
-    Reference = namedtuple('Reference', ['img', 'angle', 'points', 'descriptor'])
+    Reference = namedtuple('Reference', ['img', 'angle', 'points', 'descriptor', 'pts'])
     RefMatch = namedtuple('RefMatch', ['ref_angle', 'num_matches'])
+    RefMatches = namedtuple('RefMatches', ['ref', 'ref_idx', 'img_idx'])
 
-    def __init__(self, ref_imgs, ref_angles, vision_params:VisionParams, intrinsic_mtx=None) -> None:
+    def __init__(
+        self, ref_imgs, ref_angles, vision_params:VisionParams, intrinsic_mtx=None,
+        merged_index:bool=False, num_coarse_refs=None, preprocessor=None, keep_imgs:bool=False,
+        feature_cache=None
+    ) -> None:
         """
         Initializes the Orientation Finder
         :param ref_imgs: List with the reference images
         :param ref_angles: List with the angles of each reference image, in the same order as the images
+        :param merged_index: If True, all reference descriptors are loaded into a single
+        index and each image is matched against every reference with one k-NN query.
+        :param num_coarse_refs: If given, only this number of references, the nearest to
+        the image by bag of binary words signature, are matched. All references if None.
+        :param preprocessor: Optional src.preprocess.Preprocessor applied to the reference
+        images and to every frame before the feature extraction.
+        :param keep_imgs: If True, the references keep their image and cv2.KeyPoint objects,
+        which are only needed to draw the matches. By default only the features are kept.
+        :param feature_cache: Optional src.query_cache.QueryFeatureCache with the features of
+        already seen images, used for the references and the frames.
         """
         self.params = vision_params
+        self.keep_imgs = keep_imgs
 
         self.intrinsic_mtx = intrinsic_mtx
+        self.preprocessor = preprocessor
 
-        self.detector = cv2.ORB_create(
-            nfeatures=self.params.nfeatures, scaleFactor=self.params.scaleFactor,
-            patchSize=self.params.patchSize, edgeThreshold=self.params.patchSize
-        )
-        self.matcher = cv2.FlannBasedMatcher(
-            indexParams={ 'algorithm':6, 'table_number':6, 'key_size':12, 'multi_probe_level':1},
-            searchParams={'checks': self.params.checks}
-        )
+        # Each thread gets its own detector, so batches can run concurrently
+        self.thread_local = threading.local()
+        # Optional src.profiler.StageProfiler recording the time of each stage
+        self.profiler = None
+        # Optional src.query_cache.QueryFeatureCache, so repeated images skip the detector
+        self.feature_cache = feature_cache
+        # Panorama of the references, built on first use by the PANORAMA method
+        self.panorama = None
+        self.panorama_lock = threading.Lock()
 
         self.references = [
-            self.Reference(ref_img, ref_angles[i], *self.detector.detectAndCompute(ref_img, None))
+            self.build_reference(ref_img, ref_angles[i])
             for i, ref_img in enumerate(ref_imgs)
         ]
 
+        self.setup_matching(merged_index, num_coarse_refs)
+
+    @classmethod
+    def from_features(
+        cls, ref_angles, ref_pts, ref_descriptors, vision_params:VisionParams,
+        intrinsic_mtx=None, merged_index:bool=False, num_coarse_refs=None, preprocessor=None,
+        feature_cache=None
+    ):
+        """
+        Builds an Orientation Finder from already extracted reference features.
+        No reference image is decoded nor processed by the detector.
+        :param ref_angles: List with the angles of each reference.
+        :param ref_pts: List with the (N, 2) keypoint coordinates of each reference.
+        :param ref_descriptors: List with the descriptors of each reference.
+        :param merged_index: If True, all references are matched with a single query.
+        :param num_coarse_refs: If given, only this number of references, the nearest by
+        global signature, are matched.
+        :param preprocessor: Preprocessor applied to the frames. It should be the one
+        the reference features were extracted with.
+        :param feature_cache: Optional src.query_cache.QueryFeatureCache used for the frames.
+        :return: OrientationFinder
+        """
+        orientation_finder = cls(
+            [], [], vision_params, intrinsic_mtx, preprocessor=preprocessor, feature_cache=feature_cache
+        )
+        orientation_finder.references = [
+            cls.Reference(None, angle, None, descriptor, pts)
+            for angle, pts, descriptor in zip(ref_angles, ref_pts, ref_descriptors)
+        ]
+        orientation_finder.setup_matching(merged_index, num_coarse_refs)
+        return orientation_finder
+
+    def __getstate__(self):
+        """
+        Only the parameters and the reference features are pickled,
+        the OpenCV objects are rebuilt when unpickling. The feature cache and
+        the profiler are not pickled, so the copy has neither.
+        """
+        return {
+            'params': self.params, 'intrinsic_mtx': self.intrinsic_mtx,
+            'merged_index': self.merged_index, 'num_coarse_refs': self.num_coarse_refs,
+            'preprocessor': self.preprocessor,
+            'ref_angles': [ref.angle for ref in self.references],
+            'ref_pts': [np.asarray(ref.pts) for ref in self.references],
+            'ref_descriptors': [np.asarray(ref.descriptor) for ref in self.references],
+        }
+
+    def __setstate__(self, state):
+        orientation_finder = self.from_features(
+            state['ref_angles'], state['ref_pts'], state['ref_descriptors'],
+            state['params'], state['intrinsic_mtx'], state['merged_index'], state['num_coarse_refs'],
+            state['preprocessor']
+        )
+        self.__dict__.update(orientation_finder.__dict__)
+
+    @property
+    def detector(self):
+        """
+        Feature detector of the current thread, set by the vision parameters.
+        """
+        detector = getattr(self.thread_local, 'detector', None)
+        if detector is None:
+            detector = create_detector(self.params)
+            self.thread_local.detector = detector
+        return detector
+
+    def stage(self, name:str):
+        """
+        Context manager that times a stage when a profiler is set.
+        :param name: Name of the stage.
+        """
+        return nullcontext() if self.profiler is None else self.profiler.stage(name)
+
+    def count(self, name:str, value:int):
+        """
+        Records a count when a profiler is set.
+        :param name: Name of the count.
+        :param value: Counted value.
+        """
+        if self.profiler is not None:
+            self.profiler.count(name, value)
+
+    def build_reference(self, ref_img, ref_angle):
+        """
+        Extracts the features of a reference image.
+        The keypoint coordinates are stored as a (N, 2) float32 array.
+        :param ref_img: Reference image.
+        :param ref_angle: Angle of the reference image.
+        :return: Reference
+        """
+        if not self.keep_imgs:
+            _, pts, descriptor = self.detect(ref_img)
+            return self.Reference(None, ref_angle, None, descriptor, pts)
+        # The cache does not keep the cv2.KeyPoint objects
+        points, pts, descriptor = self.extract(ref_img)
+        return self.Reference(ref_img, ref_angle, points, descriptor, pts)
+
+    def detect(self, img):
+        """
+        Extracts the features of an image, or takes them from the feature cache if it has them.
+        :param img: Image.
+        :return: Keypoints of the detector, their (N, 2) float32 coordinates in
+        the original image and descriptors. The keypoints are None when the
+        features come from the cache.
+        """
+        if self.feature_cache is None:
+            return self.extract(img)
+        pts, descriptor, _ = self.cached_features(img)
+        return None, pts, descriptor
+
+    def cached_features(self, img, img_hash:str=None):
+        """
+        Returns the features of an image from the feature cache, extracting and
+        caching them if it does not have them yet.
+        :param img: Image.
+        :param img_hash: Precomputed src.query_cache.image_hash of the image, if known.
+        :return: (N, 2) float32 keypoint coordinates, descriptors and extraction time in seconds.
+        The time is the one measured when the features were extracted.
+        """
+        key, features = self.lookup_features(img, img_hash)
+        if features is not None:
+            return features
+        return self.extract_into_cache(key, img)
+
+    def timed_cached_features(self, img):
+        """
+        Returns the features of an image like cached_features, with the time they would take
+        without a cache: the time of the hashing and lookup plus the extraction time, the
+        stored one or the one just measured. Saving new features to the cache is not counted.
+        :param img: Image.
+        :return: (N, 2) float32 keypoint coordinates, descriptors and time in seconds.
+        """
+        start_time = time.perf_counter()
+        key, features = self.lookup_features(img)
+        lookup_time = time.perf_counter() - start_time
+        if features is None:
+            features = self.extract_into_cache(key, img)
+        pts, descriptor, extraction_time = features
+        return pts, descriptor, lookup_time + extraction_time
+
+    def lookup_features(self, img, img_hash:str=None):
+        """
+        Looks up the features of an image in the feature cache.
+        :param img: Image.
+        :param img_hash: Precomputed src.query_cache.image_hash of the image, if known.
+        :return: Cache key of the image and its cached features, or None if not cached.
+        """
+        with self.stage('feature_cache'):
+            if img_hash is None:
+                img_hash = image_hash(img)
+            key = (extraction_key(self.params, self.preprocessor), img_hash)
+            return key, self.feature_cache.get(key)
+
+    def extract_into_cache(self, key, img):
+        """
+        Extracts the features of an image and adds them to the feature cache.
+        :param key: Cache key of the image, see lookup_features.
+        :param img: Image.
+        :return: (N, 2) float32 keypoint coordinates, descriptors and extraction time in seconds.
+        """
+        start_time = time.perf_counter()
+        _, pts, descriptor = self.extract(img)
+        extraction_time = time.perf_counter() - start_time
+        self.feature_cache.put(key, pts, descriptor, extraction_time)
+        return pts, descriptor, extraction_time
+
+    def extract(self, img):
+        """
+        Preprocesses the image, if there is a preprocessor, and extracts its features.
+        :param img: Image.
+        :return: Keypoints of the detector, their (N, 2) float32 coordinates in
+        the original image and descriptors.
+        """
+        if self.preprocessor is not None:
+            with self.stage('preprocess'):
+                img = self.preprocessor(img)
+        with self.stage('detectAndCompute'):
+            points, descriptor = self.detector.detectAndCompute(img, None)
+        pts = self.keypoints_to_array(points)
+        if self.preprocessor is not None:
+            pts = self.preprocessor.restore_pts(pts)
+        return points, pts, descriptor
+
+    @staticmethod
+    def keypoints_to_array(points):
+        """
+        Converts keypoints to their coordinates.
+        :param points: Sequence of cv2.KeyPoint.
+        :return: np.array of shape (N, 2) and dtype float32.
+        """
+        if len(points) == 0:
+            return np.empty((0, 2), dtype=np.float32)
+        return cv2.KeyPoint_convert(points).reshape(-1, 2)
+
+    def setup_matching(self, merged_index:bool, num_coarse_refs):
+        """
+        Builds the structures used to match the references, after they are set.
+        :param merged_index: If True, all references are matched with a single query.
+        :param num_coarse_refs: If given, only this number of references, the nearest by
+        global signature, are matched.
+        """
+        self.panorama = None
+        self.compact_references()
+        self.merged_index = merged_index
+        if self.merged_index and self.references:
+            self.build_merged_index()
+        self.num_coarse_refs = num_coarse_refs
+        if self.num_coarse_refs is not None and self.references:
+            self.build_coarse_index()
+
+    def compact_references(self):
+        """
+        Moves the features of all references into two contiguous blocks, one with the
+        float32 keypoint coordinates and one with the uint8 descriptors, and makes each
+        reference a view of its slice of them. The offsets give the slice of each reference.
+        References that are already adjacent slices of one block, such as those of a
+        src.reference_db database, use it in place. Other memory-mapped references are
+        kept as they are, instead of being copied into RAM, and have no blocks.
+        """
+        descriptors = [ref.descriptor for ref in self.references]
+        num_descriptors = [0 if descriptor is None else len(descriptor) for descriptor in descriptors]
+        self.ref_offsets = np.concatenate(([0], np.cumsum(num_descriptors))).astype(np.int32)
+        if self.references and all(descriptor is not None for descriptor in descriptors):
+            self.ref_descriptor_block = self.adjacent_block(descriptors)
+            self.ref_pts_block = self.adjacent_block([ref.pts for ref in self.references])
+            if self.ref_descriptor_block is not None and self.ref_pts_block is not None:
+                return
+            if any(isinstance(descriptor, np.memmap) for descriptor in descriptors):
+                self.ref_descriptor_block = self.ref_pts_block = None
+                return
+
+        descriptor_size = max(
+            (descriptor.shape[1] for descriptor in descriptors if descriptor is not None),
+            default=32
+        )
+        self.ref_descriptor_block = np.empty((self.ref_offsets[-1], descriptor_size), dtype=np.uint8)
+        self.ref_pts_block = np.empty((self.ref_offsets[-1], 2), dtype=np.float32)
+        for i, ref in enumerate(self.references):
+            start, end = self.ref_offsets[i], self.ref_offsets[i + 1]
+            if descriptors[i] is not None:
+                self.ref_descriptor_block[start:end] = descriptors[i]
+            self.ref_pts_block[start:end] = np.asarray(ref.pts).reshape(-1, 2)
+            self.references[i] = ref._replace(
+                descriptor=self.ref_descriptor_block[start:end], pts=self.ref_pts_block[start:end]
+            )
+
+    @staticmethod
+    def adjacent_block(arrays):
+        """
+        Returns the block the arrays are adjacent slices of, in order, without copying them.
+        :param arrays: List of 2D np.arrays.
+        :return: View of the block spanning all the arrays, or None if they are not
+        adjacent slices of one C-contiguous block.
+        """
+        if not all(isinstance(array, np.ndarray) and array.ndim == 2 for array in arrays):
+            return None
+        block = arrays[0]
+        while isinstance(block.base, np.ndarray):
+            block = block.base
+        if block.ndim != 2 or not block.flags.c_contiguous or block.strides[0] == 0:
+            return None
+        block_start = block.__array_interface__['data'][0]
+        position = arrays[0].__array_interface__['data'][0]
+        start_row, remainder = divmod(position - block_start, block.strides[0])
+        if start_row < 0 or remainder:
+            return None
+        for array in arrays:
+            if (
+                array.dtype != block.dtype or array.shape[1] != block.shape[1]
+                or not array.flags.c_contiguous or array.__array_interface__['data'][0] != position
+            ):
+                return None
+            position += array.nbytes
+        end_row = (position - block_start)//block.strides[0]
+        if end_row > len(block):
+            return None
+        return block[start_row:end_row]
+
+    @staticmethod
+    def reference_nbytes(ref) -> int:
+        """
+        Returns the bytes held by a reference: its slices of the feature blocks and,
+        when kept, its image and cv2.KeyPoint objects.
+        """
+        nbytes = ref.descriptor.nbytes + ref.pts.nbytes
+        if ref.img is not None:
+            nbytes += ref.img.nbytes
+        if ref.points is not None:
+            nbytes += sum(sys.getsizeof(point) for point in ref.points)
+        return nbytes
+
+    def memory_usage(self) -> dict:
+        """
+        Returns the resident bytes of the finder by part. The native memory of the
+        FLANN indices, their hash tables and copies of the descriptors, is not included.
+        :return: Dict with the bytes of each reference, under "references", of each
+        optional structure and their "total".
+        """
+        usage = {
+            "references": [self.reference_nbytes(ref) for ref in self.references],
+            "merged_index": 0, "coarse_index": 0, "panorama": 0,
+        }
+        if self.merged_index and self.references:
+            usage["merged_index"] = self.ref_ids.nbytes
+        if self.num_coarse_refs is not None and self.references:
+            usage["coarse_index"] = self.vocabulary.words.nbytes + self.ref_signatures.nbytes
+        if self.panorama is not None:
+            usage["panorama"] = (
+                self.panorama.descriptors.nbytes + self.panorama.bearings.nbytes
+                + self.panorama.elevations.nbytes
+            )
+        usage["total"] = (
+            sum(usage["references"]) + self.ref_offsets.nbytes
+            + usage["merged_index"] + usage["coarse_index"] + usage["panorama"]
+        )
+        return usage
+
+    def nbytes(self) -> int:
+        """
+        Returns the total resident bytes of the finder, see memory_usage.
+        """
+        return self.memory_usage()["total"]
+
+    def build_coarse_index(self):
+        """
+        Builds the bag of binary words vocabulary and the signature of each reference.
+        """
+        self.vocabulary = BinaryVocabulary(np.vstack([ref.descriptor for ref in self.references]))
+        self.ref_signatures = np.array([
+            self.vocabulary.signature(ref.descriptor) for ref in self.references
+        ])
+
+    def get_coarse_ref_ids(self, img_descriptors):
+        """
+        Returns the references nearest to the image by global signature.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: Positions of the num_coarse_refs nearest references.
+        """
+        with self.stage('coarse_signature'):
+            distances = self.vocabulary.distances(
+                self.vocabulary.signature(img_descriptors), self.ref_signatures
+            )
+        return np.argsort(distances, kind='stable')[:self.num_coarse_refs].tolist()
+
+    def build_merged_index(self):
+        """
+        Builds a single index with the descriptors of all references.
+        Each descriptor is tagged with the position of its reference,
+        and the offsets convert global indices back to reference indices.
+        """
+        self.ref_ids = np.repeat(
+            np.arange(len(self.references), dtype=np.int32), np.diff(self.ref_offsets)
+        )
+        if self.ref_descriptor_block is None:
+            # Memory-mapped references that are not adjacent, so the index gets its own copy
+            self.ref_index = create_index(np.vstack([ref.descriptor for ref in self.references]), self.params)
+        else:
+            self.ref_index = create_index(self.ref_descriptor_block, self.params)
+
+    @staticmethod
+    def check_img_descriptors(img_descriptors):
+        """
+        Raises a ValueError if the image does not have enough features to be matched.
+        FLANN crashes instead of raising on them.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        """
+        if img_descriptors is None or len(img_descriptors) < 2:
+            raise ValueError("The image needs at least two features to be matched")
+
+    def build_img_index(self, img_descriptors):
+        """
+        Builds the nearest neighbours index over the image descriptors.
+        It is built once per image and queried by every reference.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: Index of src.backends set by the vision parameters.
+        """
+        self.check_img_descriptors(img_descriptors)
+        with self.stage('build_img_index'):
+            return create_index(img_descriptors, self.params)
+
+    def knn_match(self, ref, img_index, k=2):
+        """
+        Runs the k-NN query of the reference descriptors against the image.
+        :param ref: Reference to be matched.
+        :param img_index: Index over the image descriptors.
+        :param k: Number of neighbours.
+        :return: Distances and indices of the neighbours as contiguous
+        np.arrays of shape (N, k). Missing neighbours have index -1.
+        """
+        with self.stage('knnMatch'):
+            indices, distances = img_index.knn_search(ref.descriptor, k)
+        return np.ascontiguousarray(distances), np.ascontiguousarray(indices)
+
+    def ratio_test(self, distances, indices):
+        """
+        Applies the distance ratio test to all matches at once.
+        :param distances: Distances of the two nearest neighbours, shape (N, 2).
+        :param indices: Indices of the two nearest neighbours, shape (N, 2).
+        :return: Boolean mask of the strong matches.
+        """
+        return (
+            (indices[:, 1] >= 0)
+            & (distances[:, 0] < self.params.dist_ratio_thres*distances[:, 1].astype(np.float32))
+        )
+
+    def match_reference(self, ref, img_descriptors, img_index=None):
+        """
+        Matches a reference against the image, running a single k-NN query.
+        Only the matches that pass the distance ratio test are kept.
+        :param ref: Reference image to be matched. Has the descriptors and points.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :param img_index: Index over the image descriptors. If None, it is built.
+        :return: RefMatches with the indices of the strongly matched points
+        in the reference and in the image.
+        """
+        if img_index is None:
+            img_index = self.build_img_index(img_descriptors)
+        distances, indices = self.knn_match(ref, img_index)
+        with self.stage('ratio_test'):
+            strong = self.ratio_test(distances, indices)
+            ref_idx = np.flatnonzero(strong).astype(np.int32)
+            img_idx = indices[strong, 0]
+        return self.RefMatches(ref, ref_idx, img_idx)
+
+    def match_references(self, img_descriptors, ref_ids=None, early_exit_matches=None):
+        """
+        Matches every reference against the image, once each.
+        The results are shared by the reference ranking and the pose recovery.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :param ref_ids: Positions of the references to match. If None, all references
+        or, when num_coarse_refs is set, the nearest ones by global signature.
+        With the merged index all references are matched anyway, in a single query.
+        :param early_exit_matches: If given, matching stops at the first reference with
+        this number of matches, and the remaining references are left out of the list.
+        It has no effect with the merged index.
+        :return: List of RefMatches, in the same order as the references, and whether the
+        matching stopped early, leaving references unmatched.
+        """
+        self.check_img_descriptors(img_descriptors)
+        if ref_ids is None and self.num_coarse_refs is not None:
+            ref_ids = self.get_coarse_ref_ids(img_descriptors)
+        if ref_ids is None:
+            ref_ids = range(len(self.references))
+        if self.merged_index:
+            ref_matches_list = self.match_references_merged(img_descriptors)
+            return [ref_matches_list[i] for i in ref_ids], False
+        img_index = self.build_img_index(img_descriptors)
+        ref_matches_list = []
+        for n, i in enumerate(ref_ids):
+            ref_matches = self.match_reference(self.references[i], img_descriptors, img_index)
+            ref_matches_list.append(ref_matches)
+            if (
+                early_exit_matches is not None and len(ref_matches.ref_idx) >= early_exit_matches
+                and n < len(ref_ids) - 1
+            ):
+                self.count('early_exits', 1)
+                return ref_matches_list, True
+        return ref_matches_list, False
+
+    def match_references_merged(self, img_descriptors):
+        """
+        Matches the image against all references with a single k-NN query on the merged index.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: List of RefMatches, in the same order as the references.
+        """
+        k = self.params.merged_knn
+        with self.stage('knnMatch'):
+            indices, distances = self.ref_index.knn_search(img_descriptors, k)
+        with self.stage('ratio_test'):
+            return self.merged_ratio_test(distances, indices)
+
+    def merged_ratio_test(self, distances, indices):
+        """
+        Applies the distance ratio test per reference to the neighbours found in the merged index.
+        For every image descriptor, the nearest neighbour of each reference among the k found
+        is tested against the next neighbour of the same reference. When the reference has no
+        other neighbour among the k, the k-th distance is used, which is a lower bound for it.
+        :param distances: Distances of the k nearest neighbours of each image descriptor.
+        :param indices: Global indices of the k nearest neighbours of each image descriptor.
+        :return: List of RefMatches, in the same order as the references.
+        """
+        k = indices.shape[1]
+        distances = distances.astype(np.float32)
+        neighbour_refs = np.where(indices >= 0, self.ref_ids[np.maximum(indices, 0)], -1)
+        # Rows without k neighbours have no bound for the second distance
+        bound = np.where(indices[:, -1] >= 0, distances[:, -1], -np.inf)
+
+        img_idx, global_idx, ref_ids = [], [], []
+        for j in range(k):
+            refs_j = neighbour_refs[:, j]
+            is_first = refs_j >= 0
+            for prev in range(j):
+                is_first &= neighbour_refs[:, prev] != refs_j
+            second_dist = bound
+            for nxt in range(k - 1, j, -1):
+                second_dist = np.where(neighbour_refs[:, nxt] == refs_j, distances[:, nxt], second_dist)
+            strong = np.flatnonzero(
+                is_first & (distances[:, j] < self.params.dist_ratio_thres*second_dist)
+            )
+            img_idx.append(strong)
+            global_idx.append(indices[strong, j])
+            ref_ids.append(refs_j[strong])
+
+        img_idx = np.concatenate(img_idx).astype(np.int32)
+        global_idx = np.concatenate(global_idx).astype(np.int32)
+        ref_ids = np.concatenate(ref_ids)
+        order = np.argsort(ref_ids, kind='stable')
+        splits = np.cumsum(np.bincount(ref_ids, minlength=len(self.references)))[:-1]
+        return [
+            self.RefMatches(ref, ref_global_idx - self.ref_offsets[i], ref_img_idx)
+            for i, (ref, ref_global_idx, ref_img_idx) in enumerate(zip(
+                self.references, np.split(global_idx[order], splits), np.split(img_idx[order], splits)
+            ))
+        ]
+
     def get_num_equal_pts(self, ref, img_descriptors):
         """
         Returns the number of points that strongly match with the given
@@ -56,53 +630,52 @@ class OrientationFinder:
         :param img_descriptors: descriptors for the image points found by the detector.
         :return: number of equal/matched points between the two images.
         """
-        matches = self.matcher.knnMatch(ref.descriptor, img_descriptors, k=2)
-        # We count the number of strong matches using a heuristic distance factor
-        num_equal_pts = reduce(
-            lambda val, match:
-                val + (1 if len(match) >=2
-                            and match[0].distance < self.params.dist_ratio_thres*match[1].distance
-                         else 0),
-            matches, 0
-        )
-        return num_equal_pts
+        return len(self.match_reference(ref, img_descriptors).ref_idx)
 
-    def get_equal_pts(self, ref, img_pts, img_descriptors):
+    def get_equal_pts(self, ref, img_pts, img_descriptors, ref_matches=None):
         """
         Returns the number of points that match with the given
         image and a reference image.
         :param ref: Reference image to count the number of equal points.
         Has the descriptors and points.
-        :param img_pts: image points found by the detector.
+        :param img_pts: image points found by the detector, as keypoints or as a (N, 2) array.
         :param img_descriptors: descriptors for the image points found by the detector.
+        :param ref_matches: RefMatches already computed for this reference.
+        If None, the reference is matched again.
         :return: np.array with the matched points position in the reference and in the image.
         """
-        matches = self.matcher.knnMatch(ref.descriptor, img_descriptors, k=2)
-        # We determine the strong_matches using a heuristic distance factor
-        strong_matches = [
-            match[0] for match in matches
-            if len(match) >= 2 and match[0].distance < self.params.dist_ratio_thres*match[1].distance
-        ]
-        equal_ref_pts = np.array([ref.points[r.queryIdx].pt for r in strong_matches], dtype=np.float32)
-        equal_img_pts = np.array([img_pts[r.trainIdx].pt for r in strong_matches], dtype=np.float32)
+        if ref_matches is None:
+            ref_matches = self.match_reference(ref, img_descriptors)
+        if not isinstance(img_pts, np.ndarray):
+            img_pts = self.keypoints_to_array(img_pts)
+        equal_ref_pts = ref.pts[ref_matches.ref_idx]
+        equal_img_pts = img_pts[ref_matches.img_idx]
         return equal_ref_pts, equal_img_pts
 
+    @staticmethod
+    def get_best_match(ref_matches_list):
+        """
+        Returns the matches of the reference with the most strong matches.
+        :param ref_matches_list: List of RefMatches, one per reference.
+        :return: RefMatches of the best reference.
+        """
+        return max(ref_matches_list, key=lambda ref_matches: len(ref_matches.ref_idx))
+
     def get_best_ref(self, img_descriptors):
         """
         Returns the best reference found.
         :return: Best reference found
         """
-        best_ref = max(
-            self.references, key=lambda ref: self.get_num_equal_pts(ref, img_descriptors)
-        )
-        return best_ref
+        return self.get_best_match(self.match_references(
+            img_descriptors, early_exit_matches=self.params.early_exit_matches
+        )[0]).ref
 
     def calc_orientation_best_ref(self, img_descriptors):
         """
         Calculates the orientation according to the best reference found.
         :return: Orientation angle in degrees. Limited to [0, 360[
         """
-        return self.get_best_ref(img_descriptors).angle
+        return self.calc_orientation_features(None, img_descriptors, OrientMethod.BEST_REF)
 
     def calc_orientation_weight_avg(self, img_descriptors):
         """
@@ -112,13 +685,20 @@ class OrientationFinder:
         :param img_descriptors: descriptors for the image points found by the detector.
         :return: Orientation angle in degrees. Limited to [0, 360[
         """
+        return self.calc_orientation_features(None, img_descriptors, OrientMethod.WEIGHT_AVG)
+
+    def weight_avg_angle(self, all_ref_matches):
+        """
+        Calculates the weighted average orientation from the matches with the references.
+        :param all_ref_matches: List of RefMatches, one per reference.
+        :return: Orientation angle in degrees. Limited to [0, 360[
+        """
         # List of tuples storing the number of matches for each reference
         # The first entry is the reference angle and the second the number of matches
         ref_matches_list: list[self.RefMatch] = []
 
-        for ref in self.references:
-            points_quantity = self.get_num_equal_pts(ref, img_descriptors)
-            ref_matches_list.append(self.RefMatch(ref.angle, points_quantity))
+        for ref_matches in all_ref_matches:
+            ref_matches_list.append(self.RefMatch(ref_matches.ref.angle, len(ref_matches.ref_idx)))
 
         ref_matches_list.sort(key=lambda c: c.num_matches, reverse=True)
         main_angle = ref_matches_list[0].ref_angle
@@ -136,28 +716,175 @@ class OrientationFinder:
         angle = main_angle + delta_angle
         return angle if angle >= 0 else 360 + angle
 
-    def calc_orientation_recover_pose(self, img_pts, img_descriptors):
+    def recover_pose(self, ref_matches, img_pts, fast:bool=False):
         """
-        Calculates the orientation according to the cv2.recoverPose function.
+        Estimates the orientation from the matches with a reference, with cv2.recoverPose.
+        :param ref_matches: RefMatches of the reference.
         :param img_pts: image points found by the detector.
-        :param img_descriptors: descriptors for the image points found by the detector.
-        :return: Orientation angle in degrees. Limited to [0, 360[
+        :param fast: If True, USAC_FAST is used instead of USAC_ACCURATE.
+        :return: Orientation angle in degrees, limited to [0, 360[, and number of inliers.
+        """
+        angle, inliers = self.try_recover_pose(ref_matches, img_pts, fast)
+        return angle, 0 if inliers is None else int(np.count_nonzero(inliers))
+
+    def try_recover_pose(self, ref_matches, img_pts, fast:bool=False):
+        """
+        Estimates the orientation from the matches with a reference, with cv2.recoverPose.
+        :param ref_matches: RefMatches of the reference.
+        :param img_pts: image points found by the detector.
+        :param fast: If True, USAC_FAST is used instead of USAC_ACCURATE.
+        :return: Orientation angle in degrees, limited to [0, 360[, and the recoverPose
+        inlier mask of the matches. If recoverPose fails, the reference angle and None.
         """
-        ref = self.get_best_ref(img_descriptors)
-        equal_ref_pts, equal_img_pts = self.get_equal_pts(ref, img_pts, img_descriptors)
+        ref = ref_matches.ref
+        equal_ref_pts, equal_img_pts = self.get_equal_pts(ref, img_pts, None, ref_matches)
+        self.count('matches', len(equal_ref_pts))
         try:
-            _, _, rotation_mtx, translation_versor, inliers = cv2.recoverPose(
-                points1=equal_ref_pts, points2=equal_img_pts, cameraMatrix1=self.intrinsic_mtx,
-                distCoeffs1=None, cameraMatrix2=self.intrinsic_mtx, distCoeffs2=None,
-                method=cv2.USAC_ACCURATE, prob=self.params.prob, threshold=self.params.threshold
-            )
+            with self.stage('recoverPose'):
+                num_inliers, _, rotation_mtx, translation_versor, inliers = cv2.recoverPose(
+                    points1=equal_ref_pts, points2=equal_img_pts, cameraMatrix1=self.intrinsic_mtx,
+                    distCoeffs1=None, cameraMatrix2=self.intrinsic_mtx, distCoeffs2=None,
+                    method=cv2.USAC_FAST if fast else cv2.USAC_ACCURATE,
+                    prob=self.params.prob, threshold=self.params.threshold
+                )
+            self.count('inliers', num_inliers)
             # Robot's yaw is camera's pitch
-            _, delta_pitch, _ = calc_euler_angles(rotation_mtx)
-            return (ref.angle + delta_pitch)%360
+            with self.stage('euler_angles'):
+                _, delta_pitch, _ = calc_euler_angles(rotation_mtx)
+            return (ref.angle + delta_pitch)%360, inliers
         except cv2.error:
             # Hack: for some reason, on the reference images, opencv uses the wrong
             # overloaded function and it raises an assertion error.
-            return ref.angle
+            return ref.angle, None
+
+    @staticmethod
+    def fit_yaw(yaws, tilts, threshold:float, confidence:float):
+        """
+        Fits a rotation about the vertical axis, with a small common tilt, to the matches.
+        Each match is by itself a hypothesis for both. The hypotheses are drawn and scored
+        in vectorized batches until, given the best inlier ratio found, the confidence is reached.
+        :param yaws: np.array with the azimuth change of each match, in radians.
+        :param tilts: np.array with the elevation change of each match, in radians.
+        :param threshold: Inlier threshold, in radians.
+        :param confidence: Probability of drawing at least one inlier hypothesis.
+        :return: Yaw in radians, limited to ]-pi, pi], and the inlier mask of the matches.
+        """
+        # Deterministic, so the same frame always gets the same estimate
+        rng = np.random.default_rng(0)
+        batch_size = 32
+        best_inliers = np.zeros(len(yaws), dtype=bool)
+        num_drawn = 0
+        num_needed = len(yaws)
+        while num_drawn < num_needed:
+            samples = rng.integers(0, len(yaws), batch_size)
+            inliers = (
+                (np.abs(np.angle(np.exp(1j*(yaws[None, :] - yaws[samples, None])))) < threshold)
+                & (np.abs(tilts[None, :] - tilts[samples, None]) < threshold)
+            )
+            num_inliers = inliers.sum(axis=1)
+            best = np.argmax(num_inliers)
+            if num_inliers[best] > best_inliers.sum():
+                best_inliers = inliers[best]
+            num_drawn += batch_size
+            # Number of single match samples needed to draw an inlier with the confidence
+            inlier_ratio = best_inliers.sum()/len(yaws)
+            if inlier_ratio >= 1:
+                break
+            num_needed = min(len(yaws), np.log(1 - confidence)/np.log(1 - inlier_ratio))
+        # Least squares on the circle over the inliers
+        return np.angle(np.exp(1j*yaws[best_inliers]).mean()), best_inliers
+
+    def estimate_yaw(self, ref_matches, img_pts):
+        """
+        Estimates the orientation from the matches with a reference, assuming the camera
+        mostly rotated about its vertical axis. Each match then adds the same angle to the
+        azimuth of its bearing and, when the camera also tilted slightly, the same angle to
+        its elevation. Both are fitted with fit_yaw.
+        :param ref_matches: RefMatches of the reference.
+        :param img_pts: image points found by the detector.
+        :return: Orientation angle in degrees, limited to [0, 360[, and the inlier mask
+        of the matches. Without inliers, the reference angle.
+        """
+        ref = ref_matches.ref
+        equal_ref_pts, equal_img_pts = self.get_equal_pts(ref, img_pts, None, ref_matches)
+        self.count('matches', len(equal_ref_pts))
+        if len(equal_ref_pts) == 0:
+            return ref.angle, np.zeros(0, dtype=bool)
+        with self.stage('yaw_ransac'):
+            ref_azimuths, ref_elevations = calc_bearing_angles(equal_ref_pts, self.intrinsic_mtx)
+            img_azimuths, img_elevations = calc_bearing_angles(equal_img_pts, self.intrinsic_mtx)
+            yaw, inliers = self.fit_yaw(
+                img_azimuths - ref_azimuths, img_elevations - ref_elevations,
+                # Pixel threshold as an angle at the principal point
+                self.params.yaw_threshold/self.intrinsic_mtx[0, 0], self.params.yaw_confidence
+            )
+        self.count('inliers', int(inliers.sum()))
+        return (ref.angle + np.rad2deg(yaw))%360, inliers
+
+    def get_panorama(self) -> Panorama:
+        """
+        Returns the panorama of the references, stitching it on the first call.
+        """
+        with self.panorama_lock:
+            if self.panorama is None:
+                self.panorama = Panorama(self.references, self.intrinsic_mtx, self.params)
+            return self.panorama
+
+    def estimate_panorama(self, img_pts, img_descriptors):
+        """
+        Estimates the orientation from a single match of the image against the panorama.
+        Every matched keypoint gives the heading as its panorama bearing plus its azimuth
+        in the image, and the headings are fitted with fit_yaw, along with a small tilt.
+        :param img_pts: image points found by the detector, as keypoints or as a (N, 2) array.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: Orientation angle in degrees, limited to [0, 360[, and the inlier mask
+        of the matches.
+        """
+        self.check_img_descriptors(img_descriptors)
+        if not isinstance(img_pts, np.ndarray):
+            img_pts = self.keypoints_to_array(img_pts)
+        panorama = self.get_panorama()
+        with self.stage('knnMatch'):
+            pano_idx, img_idx = panorama.match(img_descriptors)
+        self.count('matches', len(img_idx))
+        if len(img_idx) == 0:
+            raise ValueError("The image matches no panorama keypoint")
+        with self.stage('yaw_ransac'):
+            img_azimuths, img_elevations = calc_bearing_angles(img_pts[img_idx], self.intrinsic_mtx)
+            heading, inliers = self.fit_yaw(
+                panorama.bearings[pano_idx] + img_azimuths,
+                img_elevations - panorama.elevations[pano_idx],
+                panorama.threshold, self.params.yaw_confidence
+            )
+        self.count('inliers', int(inliers.sum()))
+        return np.rad2deg(heading)%360, inliers
+
+    def calc_orientation_panorama(self, img_pts, img_descriptors):
+        """
+        Calculates the orientation with a single match against the panorama of the references.
+        :param img_pts: image points found by the detector.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: Orientation angle in degrees. Limited to [0, 360[
+        """
+        return self.calc_orientation_features(img_pts, img_descriptors, OrientMethod.PANORAMA)
+
+    def calc_orientation_yaw_ransac(self, img_pts, img_descriptors):
+        """
+        Calculates the orientation with a rotation only yaw model, fitted with RANSAC.
+        :param img_pts: image points found by the detector.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: Orientation angle in degrees. Limited to [0, 360[
+        """
+        return self.calc_orientation_features(img_pts, img_descriptors, OrientMethod.YAW_RANSAC)
+
+    def calc_orientation_recover_pose(self, img_pts, img_descriptors):
+        """
+        Calculates the orientation according to the cv2.recoverPose function.
+        :param img_pts: image points found by the detector.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: Orientation angle in degrees. Limited to [0, 360[
+        """
+        return self.calc_orientation_features(img_pts, img_descriptors, OrientMethod.RECOVER_POSE)
 
     def calc_orientation(self, img,  method=OrientMethod.RECOVER_POSE):
         """
@@ -167,11 +894,160 @@ class OrientationFinder:
         :return: Orientation angle in degrees. Limited to [0, 360[
         """
 
-        img_pts, img_descriptors = self.detector.detectAndCompute(img, None)
+        _, img_pts, img_descriptors = self.detect(img)
+        self.count('features', len(img_pts))
+        return self.calc_orientation_features(img_pts, img_descriptors, method)
+
+    def calc_orientation_features(self, img_pts, img_descriptors, method=OrientMethod.RECOVER_POSE):
+        """
+        Calculates the orientation from already extracted image features.
+        :param img_pts: image points found by the detector, as keypoints or as a (N, 2) array.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :param method: Method in which to estimate the orientation
+        :return: Orientation angle in degrees. Limited to [0, 360[
+        """
+        return self.calc_orientation_result_features(img_pts, img_descriptors, method).heading
+
+    def calc_orientation_result(self, img, method=OrientMethod.RECOVER_POSE):
+        """
+        Calculates the orientation using the desired mode, along with how it was found.
+        :param img: Image in which the orientation is to be calculated
+        :param method: Method in which to estimate the orientation
+        :return: OrientationResult
+        """
+        _, img_pts, img_descriptors = self.detect(img)
+        self.count('features', len(img_pts))
+        return self.calc_orientation_result_features(img_pts, img_descriptors, method)
+
+    def calc_orientation_result_features(
+        self, img_pts, img_descriptors, method=OrientMethod.RECOVER_POSE
+    ):
+        """
+        Calculates the orientation from already extracted image features, along with how it was found.
+        The early exit and fast pose paths are taken according to
+        params.early_exit_matches and params.fast_pose_margin.
+        :param img_pts: image points found by the detector, as keypoints or as a (N, 2) array.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :param method: Method in which to estimate the orientation
+        :return: OrientationResult
+        """
+        matches = None
+        if method != OrientMethod.PANORAMA:
+            matches = self.match_references(
+                img_descriptors, early_exit_matches=self.params.early_exit_matches
+            )
+        return self.calc_orientation_result_matches(img_pts, img_descriptors, matches, method)
+
+    def calc_orientation_result_matches(
+        self, img_pts, img_descriptors, matches, method=OrientMethod.RECOVER_POSE
+    ):
+        """
+        Calculates the orientation from the image features already matched against the
+        references, so several methods can share the extraction and the matching.
+        :param img_pts: image points found by the detector, as keypoints or as a (N, 2) array.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :param matches: List of RefMatches and early exit flag returned by match_references,
+        with the early exit of params.early_exit_matches. Unused by the panorama, which has
+        its own matching.
+        :param method: Method in which to estimate the orientation
+        :return: OrientationResult
+        """
+        if method == OrientMethod.PANORAMA:
+            heading, inliers = self.estimate_panorama(img_pts, img_descriptors)
+            return OrientationResult(
+                heading, len(inliers), None, np.count_nonzero(inliers)/len(inliers),
+                OrientPath.PANORAMA, False
+            )
+        ref_matches_list, early_exit = matches
+        num_matches = sorted((len(ref_matches.ref_idx) for ref_matches in ref_matches_list), reverse=True)
+        best_match = self.get_best_match(ref_matches_list)
+        margin = num_matches[0] - (num_matches[1] if len(num_matches) > 1 else 0)
+        inlier_ratio = None
+        if method == OrientMethod.BEST_REF:
+            heading, path = best_match.ref.angle, OrientPath.REFERENCE
+        elif method == OrientMethod.WEIGHT_AVG:
+            heading, path = self.weight_avg_angle(ref_matches_list), OrientPath.WEIGHT_AVG
+        elif method == OrientMethod.RECOVER_POSE:
+            fast = self.params.fast_pose_margin is not None and margin >= self.params.fast_pose_margin
+            heading, inliers = self.try_recover_pose(best_match, img_pts, fast)
+            if inliers is None:
+                path = OrientPath.POSE_FALLBACK
+            else:
+                path = OrientPath.FAST_POSE if fast else OrientPath.RECOVER_POSE
+                inlier_ratio = np.count_nonzero(inliers)/len(inliers) if len(inliers) else 0.
+        elif method == OrientMethod.YAW_RANSAC:
+            heading, inliers = self.estimate_yaw(best_match, img_pts)
+            path = OrientPath.YAW_RANSAC
+            inlier_ratio = np.count_nonzero(inliers)/len(inliers) if len(inliers) else 0.
+        return OrientationResult(heading, num_matches[0], margin, inlier_ratio, path, early_exit)
 
-        if  method == OrientMethod.BEST_REF:
-            return self.calc_orientation_best_ref(img_descriptors)
-        elif  method == OrientMethod.WEIGHT_AVG:
-            return self.calc_orientation_weight_avg(img_descriptors)
-        elif  method == OrientMethod.RECOVER_POSE:
-            return self.calc_orientation_recover_pose(img_pts, img_descriptors)
+    def try_calc_orientation(self, img, method=OrientMethod.RECOVER_POSE):
+        """
+        Calculates the orientation, reporting a failure instead of raising it.
+        :param img: Image in which the orientation is to be calculated
+        :param method: Method in which to estimate the orientation
+        :return: BatchResult with the angle, or with the error if it failed.
+        """
+        try:
+            return BatchResult(self.calc_orientation(img, method), None)
+        except Exception as error:
+            return BatchResult(None, error)
+
+    def calc_orientation_batch(
+        self, imgs, method=OrientMethod.RECOVER_POSE, max_workers=None, use_processes:bool=False
+    ):
+        """
+        Calculates the orientation of many images with a pool of workers.
+        OpenCV releases the GIL on the feature extraction, matching and pose recovery,
+        so threads already run them in parallel. Processes receive a copy of the finder
+        without the feature cache, so the cache is neither used nor filled by them. The stages
+        they profile are added to the profiler of the finder, if it has one.
+        :param imgs: Iterable with the images.
+        :param method: Method in which to estimate the orientation
+        :param max_workers: Number of workers. If None, the executor default is used.
+        :param use_processes: If True, a process pool is used instead of a thread pool.
+        :return: List of BatchResult in the same order as the images.
+        """
+        if not use_processes:
+            with ThreadPoolExecutor(max_workers) as executor:
+                return list(executor.map(self.try_calc_orientation, imgs, repeat(method)))
+
+        if self.feature_cache is not None:
+            warnings.warn("The feature cache is not used by the worker processes")
+        executor = ProcessPoolExecutor(
+            max_workers, initializer=_init_batch_worker, initargs=(self, self.profiler is not None)
+        )
+        results = []
+        with executor:
+            for result, timings, counts in executor.map(
+                _batch_worker_calc_orientation, imgs, repeat(method)
+            ):
+                if self.profiler is not None:
+                    self.profiler.merge(timings, counts)
+                results.append(result)
+        return results
+
+
+# Orientation Finder of each worker process of calc_orientation_batch
+_batch_worker_finder = None
+
+def _init_batch_worker(orientation_finder, profile:bool):
+    global _batch_worker_finder
+    _batch_worker_finder = orientation_finder
+    # With the fork start method the finder is not pickled, so the copy still has them
+    _batch_worker_finder.feature_cache = None
+    _batch_worker_finder.profiler = None
+    if profile:
+        _batch_worker_finder.profiler = StageProfiler()
+
+def _batch_worker_calc_orientation(img, method):
+    """
+    Returns the result of the image and the stages profiled for it, which are then reset.
+    """
+    result = _batch_worker_finder.try_calc_orientation(img, method)
+    profiler = _batch_worker_finder.profiler
+    if profiler is None:
+        return result, {}, {}
+    timings, counts = dict(profiler.timings), dict(profiler.counts)
+    profiler.reset()
+    return result, timings, counts
@@ -0,0 +1,109 @@
+import numpy as np
+import cv2
+
+from src.params import VisionParams
+from src.backends import create_index
+from src.utils import calc_bearing_angles
+
+# Two keypoints of neighbouring references are the same point of the venue when their
+# bearings agree and their descriptors differ by at most this fraction of the bits
+DUPLICATE_DISTANCE_RATIO = 0.125
+
+
+class Panorama:
+    """
+    Cylindrical feature map of a venue, stitched from its references.
+    Each keypoint stores its absolute bearing, the reference angle minus its azimuth in
+    the reference, so a frame keypoint that matches it gives the heading directly, as the
+    bearing plus its azimuth in the frame. Keypoints seen by neighbouring references are
+    stored once, and a frame is matched with a single k-NN query whatever the number
+    of references.
+    """
+
+    def __init__(self, references, intrinsic_mtx, params:VisionParams) -> None:
+        """
+        :param references: List of OrientationFinder.Reference, stitched in order.
+        :param intrinsic_mtx: Intrinsic matrix of the camera.
+        :param params: Vision parameters. The yaw_threshold also bounds the bearing
+        difference of duplicated keypoints.
+        """
+        self.params = params
+        self.intrinsic_mtx = intrinsic_mtx
+        # Pixel threshold as an angle at the principal point
+        self.threshold = params.yaw_threshold/intrinsic_mtx[0, 0]
+
+        bearings, elevations, descriptors = [], [], []
+        for ref in references:
+            if len(ref.pts) == 0:
+                continue
+            azimuths, ref_elevations = calc_bearing_angles(ref.pts, intrinsic_mtx)
+            ref_bearings = np.deg2rad(ref.angle) - azimuths
+            ref_descriptors = np.asarray(ref.descriptor)
+            if descriptors:
+                pano_bearings = np.concatenate(bearings)
+                # Only the panorama keypoints in the field of view of the reference can be duplicates
+                half_fov = np.abs(azimuths).max() + self.threshold
+                candidates = np.flatnonzero(
+                    np.abs(np.angle(np.exp(1j*(pano_bearings - np.deg2rad(ref.angle))))) <= half_fov
+                )
+                new = ~self.find_duplicates(
+                    ref_bearings, ref_elevations, ref_descriptors, pano_bearings[candidates],
+                    np.concatenate(elevations)[candidates], np.vstack(descriptors)[candidates]
+                )
+                ref_bearings = ref_bearings[new]
+                ref_elevations = ref_elevations[new]
+                ref_descriptors = ref_descriptors[new]
+            bearings.append(ref_bearings)
+            elevations.append(ref_elevations)
+            descriptors.append(ref_descriptors)
+
+        self.bearings = np.concatenate(bearings)
+        self.elevations = np.concatenate(elevations)
+        self.descriptors = np.ascontiguousarray(np.vstack(descriptors))
+        self.index = create_index(self.descriptors, params)
+
+    def find_duplicates(
+        self, bearings, elevations, descriptors, pano_bearings, pano_elevations, pano_descriptors
+    ):
+        """
+        Tells which new keypoints are already in the panorama: their nearest panorama
+        descriptor is close and was seen at the same bearing and elevation.
+        :return: Boolean mask of the new keypoints.
+        """
+        if len(pano_descriptors) == 0:
+            return np.zeros(len(descriptors), dtype=bool)
+        max_distance = DUPLICATE_DISTANCE_RATIO*8*descriptors.shape[1]
+        distances, nearest = cv2.batchDistance(
+            descriptors, pano_descriptors, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=1
+        )
+        distances, nearest = distances[:, 0], nearest[:, 0]
+        return (
+            (nearest >= 0) & (distances <= max_distance)
+            & (np.abs(np.angle(np.exp(1j*(bearings - pano_bearings[nearest])))) < self.threshold)
+            & (np.abs(elevations - pano_elevations[nearest]) < self.threshold)
+        )
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def match(self, img_descriptors):
+        """
+        Matches the frame descriptors against the panorama with a single k-NN query.
+        The ratio test is skipped when the two neighbours share their bearing,
+        since they are then the same venue point seen from two references.
+        :param img_descriptors: descriptors for the image points found by the detector.
+        :return: np.arrays with the indices of the matched panorama and frame keypoints.
+        """
+        indices, distances = self.index.knn_search(img_descriptors, 2)
+        distances = distances.astype(np.float32)
+        has_second = (indices[:, 0] >= 0) & (indices[:, 1] >= 0)
+        first, second = np.maximum(indices[:, 0], 0), np.maximum(indices[:, 1], 0)
+        same_point = has_second & (
+            np.abs(np.angle(np.exp(1j*(self.bearings[first] - self.bearings[second]))))
+            < self.threshold
+        )
+        strong = has_second & (
+            (distances[:, 0] < self.params.dist_ratio_thres*distances[:, 1]) | same_point
+        )
+        img_idx = np.flatnonzero(strong)
+        return indices[img_idx, 0], img_idx
@@ -19,6 +19,8 @@ class VisionParams:
     min_patchSize = 10
 
     dist_ratio_thres = 0.7
+    # Neighbours retrieved per image descriptor when all references share one index
+    merged_knn = 4
 
     max_checks=100
     min_checks=1
@@ -29,14 +31,55 @@ class VisionParams:
     max_threshold = 10
     min_threshold = 1
 
-    def __init__(self, nfeatures, scaleFactor, patchSize, checks, prob, threshold) -> None:
+    # Yaw RANSAC inlier threshold, in pixels, and confidence
+    max_yaw_threshold = 10
+    min_yaw_threshold = 0.5
+    max_yaw_confidence = 0.9999
+    min_yaw_confidence = 0.9
+
+    # Feature backends, see src.backends
+    detectors = ("ORB", "AKAZE", "BRISK")
+    matchers = ("LSH", "BF")
+
+    # AKAZE detector response threshold, sampled log-uniformly
+    max_akaze_threshold = 1e-2
+    min_akaze_threshold = 1e-4
+
+    # BRISK AGAST detection threshold
+    max_brisk_threshold = 80
+    min_brisk_threshold = 10
+
+    # LSH index: number of hash tables, bits of each hash key and probing level
+    max_table_number = 20
+    min_table_number = 4
+    max_key_size = 24
+    min_key_size = 10
+    max_multi_probe_level = 2
+    min_multi_probe_level = 0
+
+    def __init__(
+        self, nfeatures, scaleFactor, patchSize, checks, prob, threshold,
+        detector="ORB", matcher="LSH", akaze_threshold=1e-3, brisk_threshold=30,
+        table_number=6, key_size=12, multi_probe_level=1, early_exit_matches=None,
+        fast_pose_margin=None, yaw_threshold=2., yaw_confidence=0.999
+    ) -> None:
 
         assert (self.min_nfeatures <= nfeatures <= self.max_nfeatures)
         assert (self.min_scaleFactor <= scaleFactor <= self.max_scaleFactor)
         assert (self.min_patchSize <= patchSize <= self.max_patchSize)
         assert (self.min_checks <= checks <= self.max_checks)
         assert (self.min_threshold <= threshold <= self.max_threshold)
-        
+        assert (detector in self.detectors)
+        assert (matcher in self.matchers)
+        assert (self.min_akaze_threshold <= akaze_threshold <= self.max_akaze_threshold)
+        assert (self.min_brisk_threshold <= brisk_threshold <= self.max_brisk_threshold)
+        assert (self.min_table_number <= table_number <= self.max_table_number)
+        assert (self.min_key_size <= key_size <= self.max_key_size)
+        assert (self.min_multi_probe_level <= multi_probe_level <= self.max_multi_probe_level)
+        assert (early_exit_matches is None or early_exit_matches > 0)
+        assert (fast_pose_margin is None or fast_pose_margin >= 0)
+        assert (self.min_yaw_threshold <= yaw_threshold <= self.max_yaw_threshold)
+        assert (self.min_yaw_confidence <= yaw_confidence <= self.max_yaw_confidence)
 
         self.nfeatures = nfeatures
         self.scaleFactor = scaleFactor
@@ -45,16 +88,50 @@ class VisionParams:
         # USAC ACURATE Parameters
         self.prob = prob
         self.threshold = threshold
+        # Feature backends
+        self.detector = detector
+        self.matcher = matcher
+        self.akaze_threshold = akaze_threshold
+        self.brisk_threshold = brisk_threshold
+        self.table_number = table_number
+        self.key_size = key_size
+        self.multi_probe_level = multi_probe_level
+        # Fast paths, disabled when None.
+        # Matching stops at the first reference with this number of matches
+        self.early_exit_matches = early_exit_matches
+        # USAC_FAST replaces USAC_ACCURATE when the best reference leads the runner-up by this margin
+        self.fast_pose_margin = fast_pose_margin
+        # Yaw RANSAC Parameters
+        self.yaw_threshold = yaw_threshold
+        self.yaw_confidence = yaw_confidence
 
     @classmethod
-    def construct_random(cls):
-        nfeatures = random.randint(cls.min_nfeatures, cls.max_nfeatures)
-        scaleFactor = random.uniform(cls.min_scaleFactor, cls.max_scaleFactor)
-        patchSize = random.randint(cls.min_patchSize, cls.max_patchSize)
-        checks = random.randint(cls.min_checks, cls.max_checks)
-        prob = random.uniform(cls.min_prob, cls.max_prob)
-        threshold = random.randint(cls.min_threshold, cls.max_threshold)
-        return VisionParams(nfeatures, scaleFactor, patchSize, checks, prob, threshold)
+    def construct_random(cls, rng=random, tune_backends:bool=False):
+        """
+        :param rng: Random number generator, the random module by default.
+        A random.Random instance makes the sampled parameters reproducible.
+        :param tune_backends: If True, the detector, the matcher and their parameters
+        are also sampled. Otherwise the default ORB and LSH backends are used.
+        """
+        nfeatures = rng.randint(cls.min_nfeatures, cls.max_nfeatures)
+        scaleFactor = rng.uniform(cls.min_scaleFactor, cls.max_scaleFactor)
+        patchSize = rng.randint(cls.min_patchSize, cls.max_patchSize)
+        checks = rng.randint(cls.min_checks, cls.max_checks)
+        prob = rng.uniform(cls.min_prob, cls.max_prob)
+        threshold = rng.randint(cls.min_threshold, cls.max_threshold)
+        if not tune_backends:
+            return VisionParams(nfeatures, scaleFactor, patchSize, checks, prob, threshold)
+        return VisionParams(
+            nfeatures, scaleFactor, patchSize, checks, prob, threshold,
+            detector=rng.choice(cls.detectors), matcher=rng.choice(cls.matchers),
+            akaze_threshold=cls.min_akaze_threshold*(
+                cls.max_akaze_threshold/cls.min_akaze_threshold
+            )**rng.random(),
+            brisk_threshold=rng.randint(cls.min_brisk_threshold, cls.max_brisk_threshold),
+            table_number=rng.randint(cls.min_table_number, cls.max_table_number),
+            key_size=rng.randint(cls.min_key_size, cls.max_key_size),
+            multi_probe_level=rng.randint(cls.min_multi_probe_level, cls.max_multi_probe_level),
+        )
 
 
     @classmethod
@@ -67,6 +144,54 @@ class VisionParams:
         threshold = 1
         return VisionParams(nfeatures, scaleFactor, patchSize, checks, prob, threshold)
 
+    def as_dict(self) -> dict:
+        """
+        Returns the parameters as a dict, with the constructor argument names.
+        """
+        return {
+            "nfeatures": self.nfeatures, "scaleFactor": self.scaleFactor,
+            "patchSize": self.patchSize, "checks": self.checks,
+            "prob": self.prob, "threshold": self.threshold,
+            "detector": self.detector, "matcher": self.matcher,
+            "akaze_threshold": self.akaze_threshold, "brisk_threshold": self.brisk_threshold,
+            "table_number": self.table_number, "key_size": self.key_size,
+            "multi_probe_level": self.multi_probe_level,
+            "early_exit_matches": self.early_exit_matches,
+            "fast_pose_margin": self.fast_pose_margin,
+            "yaw_threshold": self.yaw_threshold, "yaw_confidence": self.yaw_confidence,
+        }
+
+    def detector_params(self) -> dict:
+        """
+        Returns the parameters that affect the feature extraction.
+        The matching and pose parameters do not change the keypoints or descriptors.
+        :return: Dict with the detector and its parameters.
+        """
+        if self.detector == "ORB":
+            return {
+                "detector": self.detector, "nfeatures": self.nfeatures,
+                "scaleFactor": self.scaleFactor, "patchSize": self.patchSize,
+            }
+        if self.detector == "AKAZE":
+            return {
+                "detector": self.detector, "nfeatures": self.nfeatures,
+                "akaze_threshold": self.akaze_threshold,
+            }
+        return {
+            "detector": self.detector, "nfeatures": self.nfeatures,
+            "brisk_threshold": self.brisk_threshold,
+        }
+
+    def detector_key(self) -> str:
+        """
+        Returns a key that identifies the feature extraction settings.
+        :return: String usable as a file or folder name.
+        """
+        detector_params = self.detector_params()
+        return "_".join(
+            [detector_params.pop("detector").lower()] + [repr(value) for value in detector_params.values()]
+        )
+
     def __str__(self) -> str:
         return (
               f"nfeatures: {self.nfeatures}\n"
@@ -74,5 +199,25 @@ class VisionParams:
             + f"pathSize: {self.patchSize}\n"
             + f"checks: {self.checks}\n"
             + f"prob: {self.prob}\n"
-            + f"threshold: {self.threshold}"
+            + f"threshold: {self.threshold}\n"
+            + f"detector: {self.detector}\n"
+            + f"matcher: {self.matcher}"
+            + self.backend_str()
         )
+
+    def backend_str(self) -> str:
+        """
+        Returns the lines of the backend parameters that apply to the detector and matcher.
+        """
+        lines = ""
+        if self.detector == "AKAZE":
+            lines += f"\nakaze_threshold: {self.akaze_threshold}"
+        elif self.detector == "BRISK":
+            lines += f"\nbrisk_threshold: {self.brisk_threshold}"
+        if self.matcher == "LSH":
+            lines += (
+                  f"\ntable_number: {self.table_number}"
+                + f"\nkey_size: {self.key_size}"
+                + f"\nmulti_probe_level: {self.multi_probe_level}"
+            )
+        return lines
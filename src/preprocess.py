@@ -0,0 +1,97 @@
+import time
+
+import numpy as np
+import cv2
+
+
+class Preprocessor:
+    """
+    Prepares the frames before the feature extraction: optionally crops them,
+    converts them to grayscale and downscales them, so the detector processes
+    fewer pixels. The keypoints are mapped back to the coordinates of the
+    original frame, so the camera intrinsic matrix is used unchanged.
+    """
+
+    def __init__(self, scale:float=1., crop=None, grayscale:bool=True) -> None:
+        """
+        :param scale: Resize factor applied after the crop, in ]0, 1].
+        :param crop: Region kept, as (x, y, width, height) in pixels of the original frame.
+        The whole frame if None.
+        :param grayscale: If True, color frames are converted to grayscale before resizing.
+        """
+        assert 0 < scale <= 1
+        self.scale = scale
+        self.crop = crop
+        self.grayscale = grayscale
+
+    def __call__(self, img):
+        """
+        Preprocesses a frame.
+        :param img: Frame.
+        :return: Preprocessed frame.
+        """
+        if self.crop is not None:
+            x, y, width, height = self.crop
+            img = img[y:y + height, x:x + width]
+        if self.grayscale and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.scale != 1:
+            img = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return img
+
+    def restore_pts(self, pts):
+        """
+        Maps keypoint coordinates of the preprocessed frame back to the original frame.
+        :param pts: (N, 2) float32 np.array with the coordinates in the preprocessed frame.
+        :return: (N, 2) float32 np.array with the coordinates in the original frame.
+        """
+        pts = pts/np.float32(self.scale)
+        if self.crop is not None:
+            pts += np.array(self.crop[:2], dtype=np.float32)
+        return pts
+
+    def scale_intrinsic_mtx(self, intrinsic_mtx):
+        """
+        Returns the intrinsic matrix of the preprocessed frames.
+        Only needed when working with keypoints that were not restored.
+        :param intrinsic_mtx: Intrinsic matrix of the original frames.
+        :return: Intrinsic matrix as np.array.
+        """
+        intrinsic_mtx = np.array(intrinsic_mtx, dtype=np.float64)
+        if self.crop is not None:
+            intrinsic_mtx[0, 2] -= self.crop[0]
+            intrinsic_mtx[1, 2] -= self.crop[1]
+        intrinsic_mtx[:2] *= self.scale
+        return intrinsic_mtx
+
+    def key(self) -> str:
+        """
+        Returns a key that identifies the preprocessing, to be combined with the detector key.
+        """
+        return f"s{self.scale!r}_c{'full' if self.crop is None else '-'.join(map(str, self.crop))}"
+
+    @classmethod
+    def for_target_latency(
+        cls, detector, sample_imgs, target_ms:float, scales=(1., .75, .5, .375, .25),
+        crop=None, grayscale:bool=True
+    ):
+        """
+        Picks the largest scale whose feature extraction meets a target latency.
+        Each scale is timed with the detector on the sample frames, and the median is used.
+        :param detector: Feature detector, such as OrientationFinder.detector.
+        :param sample_imgs: Frames representative of the stream.
+        :param target_ms: Target latency of the preprocessing plus extraction, in ms.
+        :param scales: Candidate scales. The smallest is used if none meets the target.
+        :return: Preprocessor
+        """
+        scales = sorted(scales, reverse=True)
+        for scale in scales:
+            preprocessor = cls(scale, crop, grayscale)
+            times = []
+            for img in sample_imgs:
+                start_time = time.perf_counter()
+                detector.detectAndCompute(preprocessor(img), None)
+                times.append(1000*(time.perf_counter() - start_time))
+            if np.median(times) <= target_ms:
+                return preprocessor
+        return preprocessor
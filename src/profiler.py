@@ -0,0 +1,109 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import time
+
+import numpy as np
+
+
+class StageProfiler:
+    """
+    Records the duration of each stage of the orientation estimation with
+    time.perf_counter_ns, along with counts such as the number of features.
+    """
+
+    def __init__(self, percentiles=(50, 95, 99)) -> None:
+        """
+        :param percentiles: Percentiles reported by the summary.
+        """
+        self.percentiles = percentiles
+        self.reset()
+
+    def reset(self):
+        """
+        Discards all records.
+        """
+        self.timings = defaultdict(list)
+        self.counts = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name:str):
+        """
+        Context manager that records the duration of a stage.
+        :param name: Name of the stage.
+        """
+        start_time = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.timings[name].append(time.perf_counter_ns() - start_time)
+
+    def count(self, name:str, value:int):
+        """
+        Records a count, such as the number of features or matches.
+        :param name: Name of the count.
+        :param value: Counted value.
+        """
+        self.counts[name].append(value)
+
+    def merge(self, timings, counts):
+        """
+        Adds the records of another profiler, such as one of a worker process.
+        :param timings: Dict with the durations of each stage, in ns.
+        :param counts: Dict with the values of each count.
+        """
+        for name, values in timings.items():
+            self.timings[name].extend(values)
+        for name, values in counts.items():
+            self.counts[name].extend(values)
+
+    def aggregate(self, values):
+        """
+        Returns the number of records, mean and percentiles of the values.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        aggregates = {"num": len(values), "mean": values.mean()}
+        for percentile, value in zip(self.percentiles, np.percentile(values, self.percentiles)):
+            aggregates[f"p{percentile}"] = value
+        return aggregates
+
+    def summary(self) -> dict:
+        """
+        Returns the aggregates of each stage, in ms, and of each count.
+        :return: Dict with the "stages" and "counts" aggregates by name.
+        """
+        return {
+            "stages": {
+                name: self.aggregate(np.array(timings)/1e6)
+                for name, timings in self.timings.items()
+            },
+            "counts": {name: self.aggregate(values) for name, values in self.counts.items()},
+        }
+
+    def to_json(self, path):
+        """
+        Saves the summary as JSON.
+        :param path: Path of the JSON file.
+        """
+        summary = self.summary()
+        for aggregates in (*summary["stages"].values(), *summary["counts"].values()):
+            for key, value in aggregates.items():
+                aggregates[key] = float(value) if key != "num" else value
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    def __str__(self) -> str:
+        lines = []
+        for name, aggregates in self.summary()["stages"].items():
+            lines.append(
+                f"{name}: " + ", ".join(
+                    f"{key} {value:.2f} ms" for key, value in aggregates.items() if key != "num"
+                ) + f" ({aggregates['num']} calls)"
+            )
+        for name, aggregates in self.summary()["counts"].items():
+            lines.append(
+                f"{name}: " + ", ".join(
+                    f"{key} {value:.0f}" for key, value in aggregates.items() if key != "num"
+                )
+            )
+        return "\n".join(lines)
@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import threading
+
+import numpy as np
+
+from src.params import VisionParams
+
+
+def image_hash(img) -> str:
+    """
+    Returns a hash of the content of an image, its pixels and shape.
+    :param img: Image.
+    :return: Hexadecimal string.
+    """
+    img = np.ascontiguousarray(img)
+    content_hash = hashlib.blake2b(digest_size=16)
+    content_hash.update(repr((img.shape, img.dtype.str)).encode())
+    content_hash.update(img.data)
+    return content_hash.hexdigest()
+
+
+def extraction_key(params:VisionParams, preprocessor=None) -> str:
+    """
+    Returns a key that identifies the feature extraction, the detector settings
+    and the preprocessing, like src.reference_db.reference_db_path.
+    """
+    key = params.detector_key()
+    if preprocessor is not None:
+        key += "_" + preprocessor.key()
+    return key
+
+
+class QueryFeatureCache:
+    """
+    Features of the frames, keyed by the content hash of each frame and the extraction
+    settings, so the same frame is only run through the detector once. The most recently
+    used features are kept in memory and, when a path is given, all of them are also
+    saved on disk and reused by later runs. Parameter sets that only differ on the
+    matching and pose parameters share their features.
+    Only the keypoint coordinates and descriptors are cached, not the cv2.KeyPoint objects,
+    along with the extraction time, so evaluations can still report comparable times.
+    The cached arrays are shared and must not be modified.
+    """
+
+    def __init__(self, max_entries:int=4096, path=None) -> None:
+        """
+        :param max_entries: Maximum number of frames kept in memory,
+        the least recently used is dropped first.
+        :param path: Folder of the disk tier, with a subfolder per extraction key.
+        If None, the features are only kept in memory.
+        """
+        assert max_entries >= 1
+        self.max_entries = max_entries
+        self.path = None if path is None else Path(path)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def file_path(self, key) -> Path:
+        """
+        Returns the path of the features of a key on disk.
+        :param key: Tuple of the extraction key and the image hash.
+        """
+        return self.path / key[0] / f"{key[1]}.npz"
+
+    def get(self, key):
+        """
+        Returns the cached features of a key, from memory or else from disk.
+        :param key: Tuple of the extraction key and the image hash.
+        :return: (N, 2) float32 keypoint coordinates, descriptors and extraction time in
+        seconds, or None if not cached.
+        """
+        with self.lock:
+            features = self.entries.get(key)
+            if features is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return features
+        if self.path is not None and self.file_path(key).exists():
+            with np.load(self.file_path(key)) as data:
+                descriptors = data["descriptors"] if data["has_descriptors"] else None
+                features = (data["pts"], descriptors, float(data["extraction_time"]))
+            with self.lock:
+                self.disk_hits += 1
+                self.add(key, features)
+            return features
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def add(self, key, features):
+        """
+        Adds features to the memory tier. Must be called holding the lock.
+        """
+        self.entries[key] = features
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, key, pts, descriptors, extraction_time:float):
+        """
+        Caches the features of a key, in memory and on disk.
+        :param key: Tuple of the extraction key and the image hash.
+        :param pts: (N, 2) float32 keypoint coordinates.
+        :param descriptors: Descriptors, None when no keypoint was found.
+        :param extraction_time: Time the extraction took, in seconds.
+        """
+        with self.lock:
+            self.add(key, (pts, descriptors, extraction_time))
+        if self.path is None:
+            return
+        file_path = self.file_path(key)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file and renamed, so a concurrent reader never sees half of it
+        tmp_path = file_path.with_name(f"{file_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npz")
+        np.savez(
+            tmp_path, pts=pts, has_descriptors=descriptors is not None, extraction_time=extraction_time,
+            descriptors=np.empty((0, 0), dtype=np.uint8) if descriptors is None else descriptors
+        )
+        os.replace(tmp_path, file_path)
+
+    def clear(self):
+        """
+        Empties the memory tier. The disk tier is kept.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters.
+        """
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits)/lookups if lookups else 0.,
+                "entries": len(self.entries),
+            }
@@ -0,0 +1,76 @@
+import numpy as np
+
+from src.orientation_finder import OrientationFinder
+from src.reference_db import save_reference_db
+from src.utils import get_angle_diffs
+
+
+def score_reference_descriptors(orientation_finder:OrientationFinder, imgs, angles):
+    """
+    Scores each reference descriptor by how uniquely it matches its own angle.
+    Every training frame is matched against all references. A strong match
+    counts for the descriptor when the reference is the nearest in angle to the
+    frame, and against it otherwise, like grass or symmetric stands that match
+    equally well at several angles.
+    :param orientation_finder: Orientation Finder with the references to be scored.
+    :param imgs: Training frames.
+    :param angles: True angle of each training frame.
+    :return: List with the np.array of scores of each reference, one per descriptor.
+    """
+    references = orientation_finder.references
+    ref_angles = np.array([ref.angle for ref in references])
+    scores = [np.zeros(len(ref.pts), dtype=np.int32) for ref in references]
+    all_ref_ids = range(len(references))
+    for img, angle in zip(imgs, angles):
+        _, _, img_descriptors = orientation_finder.detect(img)
+        try:
+            ref_matches_list, _ = orientation_finder.match_references(img_descriptors, all_ref_ids)
+        except ValueError:
+            continue
+        angle_diffs = np.abs(get_angle_diffs(angle, ref_angles))
+        own_refs = angle_diffs == angle_diffs.min()
+        for i, ref_matches in enumerate(ref_matches_list):
+            np.add.at(scores[i], ref_matches.ref_idx, 1 if own_refs[i] else -1)
+    return scores
+
+
+def compile_references(
+    orientation_finder:OrientationFinder, imgs, angles, budget:int
+) -> OrientationFinder:
+    """
+    Prunes each reference to its most discriminative descriptors.
+    The smaller references make the k-NN queries cheaper, and the discarded
+    ambiguous descriptors no longer add votes to the wrong references.
+    :param orientation_finder: Orientation Finder with all the reference descriptors.
+    :param imgs: Training frames, with known angles, of the same background.
+    :param angles: True angle of each training frame.
+    :param budget: Maximum number of descriptors kept per reference.
+    :return: New OrientationFinder, with the same settings and the pruned references.
+    """
+    scores = score_reference_descriptors(orientation_finder, imgs, angles)
+    ref_pts = []
+    ref_descriptors = []
+    for ref, ref_scores in zip(orientation_finder.references, scores):
+        keep = np.sort(np.argsort(-ref_scores, kind='stable')[:budget])
+        ref_pts.append(np.asarray(ref.pts)[keep])
+        ref_descriptors.append(np.asarray(ref.descriptor)[keep])
+    return OrientationFinder.from_features(
+        [ref.angle for ref in orientation_finder.references], ref_pts, ref_descriptors,
+        orientation_finder.params, orientation_finder.intrinsic_mtx,
+        orientation_finder.merged_index, orientation_finder.num_coarse_refs,
+        orientation_finder.preprocessor, orientation_finder.feature_cache
+    )
+
+
+def compile_reference_db(path, orientation_finder:OrientationFinder, imgs, angles, budget:int):
+    """
+    Prunes each reference to its most discriminative descriptors and saves them
+    as a reference database, so the pruning is done once, offline.
+    :param path: Database folder, see src.reference_db.reference_db_path.
+    :param orientation_finder: Orientation Finder with all the reference descriptors.
+    :param imgs: Training frames, with known angles, of the same background.
+    :param angles: True angle of each training frame.
+    :param budget: Maximum number of descriptors kept per reference.
+    """
+    compiled_finder = compile_references(orientation_finder, imgs, angles, budget)
+    save_reference_db(path, compiled_finder.references, orientation_finder.params)
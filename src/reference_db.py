@@ -0,0 +1,163 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from src.params import VisionParams
+from src.orientation_finder import OrientationFinder
+from src.query_cache import extraction_key
+
+# Version of the on-disk layout, bumped whenever it changes
+DB_FORMAT = 2
+
+MANIFEST_FILE = "manifest.json"
+PTS_FILE = "pts.npy"
+DESCRIPTORS_FILE = "descriptors.npy"
+
+
+def reference_db_path(
+    db_root, folder:str, params:VisionParams, preprocessor=None, descriptor_budget=None,
+    ref_angles=None
+) -> Path:
+    """
+    Returns the path of the reference database of a background folder.
+    The path is keyed by the detector settings, so changing them
+    leads to a new database instead of reusing stale features.
+    :param db_root: Root folder of the reference databases.
+    :param folder: Name of the background folder.
+    :param params: Vision parameters used to extract the features.
+    :param preprocessor: Preprocessor applied to the images before the extraction, if any.
+    :param descriptor_budget: Budget of a database compiled by src.reference_compiler.
+    Compiled databases are also keyed by their reference angles, since the
+    descriptors are scored against the other references.
+    :param ref_angles: Angles of the references of a compiled database.
+    :return: Path of the database folder.
+    """
+    path = Path(db_root) / folder / extraction_key(params, preprocessor)
+    if descriptor_budget is None:
+        return path
+    angles = "-".join(f"{angle:g}" for angle in sorted(ref_angles))
+    return path / f"budget_{descriptor_budget}_refs_{angles}"
+
+
+def save_reference_db(path, references, params:VisionParams):
+    """
+    Saves the features of the references.
+    The keypoints and descriptors of all references are stored in two
+    contiguous arrays, with the offsets of each reference in the manifest.
+    :param path: Database folder.
+    :param references: List of OrientationFinder.Reference.
+    :param params: Vision parameters used to extract the features.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    num_pts = [len(ref.pts) for ref in references]
+    np.save(path / PTS_FILE, np.vstack([ref.pts for ref in references]).astype(np.float32))
+    np.save(path / DESCRIPTORS_FILE, np.vstack([ref.descriptor for ref in references]))
+    manifest = {
+        "format": DB_FORMAT,
+        "detector": params.detector_params(),
+        "angles": [ref.angle for ref in references],
+        "offsets": np.concatenate(([0], np.cumsum(num_pts))).tolist(),
+    }
+    with open(path / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def check_reference_db(path, manifest, all_pts, all_descriptors):
+    """
+    Raises a ValueError if the arrays of a database do not match its manifest,
+    so a stale or corrupt database is never used with the wrong offsets.
+    :param path: Database folder, for the error message.
+    :param manifest: Loaded manifest.
+    :param all_pts: Keypoint coordinates of all references.
+    :param all_descriptors: Descriptors of all references.
+    """
+    offsets = manifest.get("offsets")
+    angles = manifest.get("angles")
+    if not isinstance(offsets, list) or not isinstance(angles, list) or len(offsets) != len(angles) + 1:
+        raise ValueError(f"{path} has a manifest without an offset per reference")
+    if offsets[0] != 0 or any(end < start for start, end in zip(offsets, offsets[1:])):
+        raise ValueError(f"{path} has decreasing offsets")
+    if all_pts.dtype != np.float32 or all_pts.ndim != 2 or all_pts.shape[1] != 2:
+        raise ValueError(f"{path} has keypoints of shape {all_pts.shape} and dtype {all_pts.dtype}")
+    if all_descriptors.dtype != np.uint8 or all_descriptors.ndim != 2:
+        raise ValueError(
+            f"{path} has descriptors of shape {all_descriptors.shape} and dtype {all_descriptors.dtype}"
+        )
+    if not len(all_pts) == len(all_descriptors) == offsets[-1]:
+        raise ValueError(
+            f"{path} has {len(all_pts)} keypoints and {len(all_descriptors)} descriptors,"
+            f" but its manifest has {offsets[-1]}"
+        )
+
+
+def load_reference_db(path, params:VisionParams, ref_angles=None):
+    """
+    Loads the features of the references, memory-mapping the arrays.
+    Raises a ValueError if the database has another format or detector settings,
+    or if its arrays do not match its manifest.
+    :param path: Database folder.
+    :param params: Vision parameters. Their detector settings must match the database.
+    :param ref_angles: Angles of the references to load. If None, all references are loaded.
+    :return: Lists with the angles, keypoint coordinates and descriptors of each reference.
+    """
+    path = Path(path)
+    with open(path / MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != DB_FORMAT:
+        raise ValueError(f"{path} has format {manifest.get('format')}, expected {DB_FORMAT}")
+    if manifest.get("detector") != params.detector_params():
+        raise ValueError(f"{path} was built with other detector parameters")
+
+    all_pts = np.load(path / PTS_FILE, mmap_mode="r")
+    all_descriptors = np.load(path / DESCRIPTORS_FILE, mmap_mode="r")
+    offsets = manifest.get("offsets")
+    check_reference_db(path, manifest, all_pts, all_descriptors)
+
+    angles, pts, descriptors = [], [], []
+    for i, angle in enumerate(manifest["angles"]):
+        if ref_angles is not None and angle not in ref_angles:
+            continue
+        angles.append(angle)
+        pts.append(all_pts[offsets[i]:offsets[i + 1]])
+        descriptors.append(all_descriptors[offsets[i]:offsets[i + 1]])
+    return angles, pts, descriptors
+
+
+def build_reference_db(path, ref_imgs, ref_angles, params:VisionParams, preprocessor=None):
+    """
+    Extracts the features of the reference images and saves them.
+    :param path: Database folder.
+    :param ref_imgs: List with the reference images.
+    :param ref_angles: List with the angles of each reference image, in the same order as the images.
+    :param params: Vision parameters used to extract the features.
+    :param preprocessor: Preprocessor applied to the images before the extraction, if any.
+    """
+    orientation_finder = OrientationFinder(
+        ref_imgs, ref_angles, params, preprocessor=preprocessor
+    )
+    save_reference_db(path, orientation_finder.references, params)
+
+
+def load_orientation_finder(
+    path, params:VisionParams, intrinsic_mtx=None, ref_angles=None, merged_index:bool=False,
+    num_coarse_refs=None, preprocessor=None
+) -> OrientationFinder:
+    """
+    Builds an OrientationFinder from a reference database, without decoding any image.
+    :param path: Database folder.
+    :param params: Vision parameters. Their detector settings must match the database.
+    :param intrinsic_mtx: Intrinsic matrix of the camera.
+    :param ref_angles: Angles of the references to use. If None, all references are used.
+    :param merged_index: If True, all references are matched with a single query.
+    :param num_coarse_refs: If given, only this number of references, the nearest by
+    global signature, are matched.
+    :param preprocessor: Preprocessor the database was built with, if any.
+    :return: OrientationFinder
+    """
+    angles, pts, descriptors = load_reference_db(path, params, ref_angles)
+    return OrientationFinder.from_features(
+        angles, pts, descriptors, params, intrinsic_mtx, merged_index, num_coarse_refs,
+        preprocessor
+    )
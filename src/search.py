@@ -0,0 +1,305 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+from math import inf, isnan
+import os
+import random
+from pathlib import Path
+
+import numpy as np
+
+from src.params import VisionParams
+from src.orientation_finder import OrientationFinder, OrientMethod
+from src.dataset import IndexedDataset, SharedDataset, DatasetCache
+from src.tester import Tester
+from src.query_cache import QueryFeatureCache, image_hash
+from src.utils import cost
+
+SearchResult = namedtuple(
+    'SearchResult',
+    ['iteration', 'params', 'time_mean', 'time_std', 'error_mean', 'error_std', 'cost']
+)
+
+
+class FeatureCache:
+    """
+    Detector output of the dataset images, kept in a src.query_cache.QueryFeatureCache,
+    so the search and Tester share one cache and one timing convention.
+    The matching and pose parameters, such as checks, prob and threshold, do not affect
+    the extraction, so parameter sets that only differ on them reuse the same features.
+    """
+
+    def __init__(self, max_entries:int=1, num_imgs:int=1, path=None) -> None:
+        """
+        :param max_entries: Number of detector settings kept in memory.
+        :param num_imgs: Number of images of the dataset, the memory tier keeps
+        max_entries times as many frames.
+        :param path: Folder of the disk tier of the cache, None to keep it in memory.
+        """
+        self.cache = QueryFeatureCache(max_entries*max(num_imgs, 1), path)
+        # Content hash of each dataset image, so each image is hashed once
+        self.hashes = {}
+
+    def get_features(self, dataset:IndexedDataset, params:VisionParams, indices):
+        """
+        Returns the features of the dataset images, extracting only the missing ones.
+        :param dataset: Dataset with the images, always the same one.
+        :param params: Vision parameters.
+        :param indices: Indices of the images.
+        :return: List of tuples (points, descriptors, extraction time in seconds).
+        """
+        finder = OrientationFinder([], [], params, feature_cache=self.cache)
+        features = []
+        for i in indices:
+            img = dataset.image(i)
+            if i not in self.hashes:
+                self.hashes[i] = image_hash(img)
+            features.append(finder.cached_features(img, self.hashes[i]))
+        return features
+
+
+def evaluate_params(
+    dataset:IndexedDataset, feature_cache:FeatureCache, params:VisionParams,
+    method:OrientMethod, ref_angles, split:str, folders, max_imgs=None, indices=None
+):
+    """
+    Evaluates the vision parameters on the dataset, like Tester.performance.
+    :param dataset: Dataset with the images.
+    :param feature_cache: Cache with the detector output.
+    :param params: Vision parameters.
+    :param method: Method in which to estimate the orientation.
+    :param ref_angles: Set with the angles of the reference images.
+    :param split: "train" or "test".
+    :param folders: Background folders to evaluate on.
+    :param max_imgs: Maximum number of images evaluated per folder. All if None.
+    :param indices: Indices of the images to evaluate. If given, only these images are
+    evaluated, instead of the split of each folder.
+    :return: np.arrays with the times in ms and with the errors in degrees.
+    """
+    tester = Tester(params, method, ref_angles, True, split)
+    times = []
+    errors = []
+    for folder in folders:
+        ref_indices = dataset.select(folder, "ref", ref_angles)
+        ref_features = feature_cache.get_features(dataset, params, ref_indices)
+        orientation_finder = OrientationFinder.from_features(
+            dataset.angles[ref_indices].tolist(),
+            [pts for pts, _, _ in ref_features], [descriptors for _, descriptors, _ in ref_features],
+            params, tester.intrinsic_mtx
+        )
+
+        folder_indices = dataset.select(folder, split=split)
+        if indices is not None:
+            folder_indices = folder_indices[np.isin(folder_indices, indices)]
+        folder_indices = folder_indices[:max_imgs]
+        folder_times, folder_errors = tester.evaluate(
+            orientation_finder, None, dataset.angles[folder_indices], dataset.cases[folder_indices],
+            feature_cache.get_features(dataset, params, folder_indices)
+        )
+        times.extend(folder_times)
+        errors.extend(folder_errors)
+    return 1000*np.array(times), np.array(errors)
+
+
+def result_cost(result:SearchResult) -> float:
+    """
+    Returns the cost of a result to rank it, infinite when no image could be evaluated
+    and the cost is NaN, so those candidates always rank last.
+    """
+    return inf if isnan(result.cost) else result.cost
+
+
+# Dataset and feature cache of each worker process
+_worker_dataset = None
+_worker_feature_cache = None
+
+def _init_search_worker(dataset, cache_entries):
+    global _worker_dataset, _worker_feature_cache
+    _worker_dataset = dataset
+    _worker_feature_cache = FeatureCache(cache_entries, len(dataset.backgrounds))
+
+def _search_worker_costs(params_list, method, ref_angles, split, folders, max_imgs, indices):
+    costs = []
+    for params in params_list:
+        times, errors = evaluate_params(
+            _worker_dataset, _worker_feature_cache, params, method, ref_angles, split, folders,
+            max_imgs, indices
+        )
+        costs.append((times.mean(), times.std(), errors.mean(), errors.std()))
+    return costs
+
+
+class ParamSearch:
+    """
+    Random search of the vision parameters.
+    The dataset is decoded once into shared memory and the candidates are evaluated
+    in parallel worker processes. Each evaluated candidate is appended to a log,
+    so an interrupted search resumes where it stopped.
+    Workers compete for the cores, so use a single worker when the times must be precise.
+    Consecutive candidates share their detector parameters and only differ on the matching
+    and pose ones. They are evaluated together by one worker, which extracts the features once,
+    unless that leaves workers idle. In exchange, a search of n candidates only explores
+    n/draws_per_detector detector settings, so use draws_per_detector=1 to explore more of them.
+    """
+
+    def __init__(
+        self, method:OrientMethod, ref_angles, split:str="train", folders=None,
+        log_path=None, num_workers=None, cache_entries:int=1, seed:int=0,
+        tune_backends:bool=False, dataset_cache=None, draws_per_detector:int=4
+    ) -> None:
+        """
+        :param method: Method in which to estimate the orientation.
+        :param ref_angles: Set with the angles of the reference images.
+        :param split: "train" or "test".
+        :param folders: Background folders. The simulated ones if None.
+        :param log_path: JSON lines file with the evaluated candidates. No log if None.
+        :param num_workers: Number of worker processes. The number of CPUs if None.
+        :param cache_entries: Number of detector settings cached by each worker.
+        :param seed: Seed of the candidates. The i-th candidate only depends on it and on i.
+        :param tune_backends: If True, the detector and matcher backends are also searched.
+        :param dataset_cache: Folder of a src.dataset.DatasetCache, built if needed. The workers
+        then map the pre-decoded images. If None, the images are decoded into shared memory.
+        :param draws_per_detector: Number of consecutive candidates that share their detector
+        parameters. With 1, every candidate has its own detector parameters, and the search
+        explores draws_per_detector times more detector settings.
+        """
+        assert draws_per_detector >= 1
+        self.method = method
+        self.ref_angles = ref_angles
+        self.split = split
+        self.folders = Tester.sim_folders if folders is None else folders
+        self.log_path = None if log_path is None else Path(log_path)
+        self.num_workers = num_workers
+        self.cache_entries = cache_entries
+        self.seed = seed
+        self.tune_backends = tune_backends
+        self.dataset_cache = dataset_cache
+        self.draws_per_detector = draws_per_detector
+
+    def candidate(self, iteration:int) -> VisionParams:
+        """
+        Returns the candidate of an iteration.
+        Its detector parameters are those of the first iteration of its detector group.
+        """
+        params = VisionParams.construct_random(
+            random.Random(f"{self.seed}:{iteration}"), self.tune_backends
+        )
+        group = iteration//self.draws_per_detector*self.draws_per_detector
+        if group == iteration:
+            return params
+        detector_params = VisionParams.construct_random(
+            random.Random(f"{self.seed}:{group}"), self.tune_backends
+        ).detector_params()
+        return VisionParams(**{**params.as_dict(), **detector_params})
+
+    def load_log(self, log_path=None):
+        """
+        Returns the results already in the log.
+        :param log_path: Log to read. The log of the search if None.
+        :return: Dict mapping the iteration to its SearchResult.
+        """
+        log_path = self.log_path if log_path is None else log_path
+        results = {}
+        if log_path is None or not log_path.exists():
+            return results
+        with open(log_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                entry["params"] = VisionParams(**entry["params"])
+                results[entry["iteration"]] = SearchResult(**entry)
+        return results
+
+    def log(self, result:SearchResult, log_path=None):
+        """
+        Appends a result to the log.
+        :param log_path: Log to append to. The log of the search if None.
+        """
+        log_path = self.log_path if log_path is None else log_path
+        if log_path is None:
+            return
+        entry = result._asdict()
+        entry["params"] = result.params.as_dict()
+        with open(log_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def open_dataset(self) -> IndexedDataset:
+        """
+        Returns the dataset shared by the worker processes. It must be closed after use.
+        """
+        if self.dataset_cache is not None:
+            return DatasetCache(self.dataset_cache, self.folders, Tester.dataset_path)
+        return SharedDataset(Tester.dataset_path, self.folders)
+
+    def open_pool(self, dataset:IndexedDataset) -> ProcessPoolExecutor:
+        """
+        Returns the pool of worker processes attached to the dataset.
+        """
+        return ProcessPoolExecutor(
+            self.num_workers, initializer=_init_search_worker,
+            initargs=(dataset, self.cache_entries)
+        )
+
+    def evaluate_candidates(
+        self, executor, iterations, folders=None, max_imgs=None, log=True, indices=None,
+        log_path=None
+    ):
+        """
+        Evaluates the candidates of the iterations in parallel.
+        :param executor: Pool returned by open_pool.
+        :param iterations: Iterations of the candidates.
+        :param folders: Background folders to evaluate on. All the search folders if None.
+        :param max_imgs: Maximum number of images evaluated per folder. All if None.
+        :param log: If True, the results are appended to the log as they arrive.
+        :param indices: Indices of the images to evaluate. The split of each folder if None.
+        :param log_path: Log the results are appended to. The log of the search if None.
+        :return: Dict mapping the iteration to its SearchResult.
+        """
+        folders = self.folders if folders is None else folders
+        # The candidates that share their detector parameters go to the same worker,
+        # in smaller tasks when there would be fewer tasks than workers
+        num_workers = self.num_workers or os.cpu_count() or 1
+        task_size = max(1, min(self.draws_per_detector, len(iterations)//num_workers))
+        groups = {}
+        for i in iterations:
+            groups.setdefault(i//self.draws_per_detector, []).append(i)
+        tasks = [
+            group[start:start + task_size]
+            for group in groups.values() for start in range(0, len(group), task_size)
+        ]
+        futures = {
+            executor.submit(
+                _search_worker_costs, [self.candidate(i) for i in task], self.method,
+                self.ref_angles, self.split, folders, max_imgs, indices
+            ): task
+            for task in tasks
+        }
+        results = {}
+        for future in as_completed(futures):
+            for i, (time_mean, time_std, error_mean, error_std) in zip(futures[future], future.result()):
+                results[i] = SearchResult(
+                    i, self.candidate(i), time_mean, time_std, error_mean, error_std,
+                    cost(time_mean, time_std, error_mean, error_std)
+                )
+                if log:
+                    self.log(results[i], log_path)
+        return results
+
+    def run(self, num_iter:int, max_imgs=None) -> SearchResult:
+        """
+        Evaluates the candidates of the iterations that are not in the log yet.
+        :param num_iter: Total number of iterations.
+        :param max_imgs: Maximum number of images evaluated per folder. All if None.
+        :return: SearchResult with the lowest cost.
+        """
+        results = self.load_log()
+        pending = [i for i in range(num_iter) if i not in results]
+        if pending:
+            dataset = self.open_dataset()
+            try:
+                with self.open_pool(dataset) as executor:
+                    results.update(
+                        self.evaluate_candidates(executor, pending, max_imgs=max_imgs)
+                    )
+            finally:
+                dataset.close()
+        return min((results[i] for i in range(num_iter)), key=result_cost)
@@ -0,0 +1,295 @@
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import socket
+import struct
+
+import numpy as np
+import cv2
+
+from src.orientation_finder import OrientationFinder, OrientMethod
+
+# Each request is a header with the request id and the payload size, followed by
+# the encoded frame (PNG, JPEG...). Each response is a line of JSON.
+REQUEST_HEADER = struct.Struct("!II")
+
+# Answer to one request. Heading and confidence are None and error is set when it fails.
+Estimate = namedtuple('Estimate', ['heading', 'confidence', 'error'])
+
+
+def estimate_orientation(orientation_finder:OrientationFinder, img, method=OrientMethod.RECOVER_POSE):
+    """
+    Estimates the orientation of an image along with a confidence in [0, 1],
+    the lead of the best reference over the runner-up relative to its match count.
+    The recoverPose inliers are not used, since with a purely rotating camera
+    their count barely depends on the accuracy of the estimate.
+    :param orientation_finder: OrientationFinder with the references of the venue.
+    :param img: Image in which the orientation is to be calculated.
+    :param method: Method in which to estimate the orientation.
+    :return: Heading in degrees, limited to [0, 360[, and confidence.
+    """
+    result = orientation_finder.calc_orientation_result(img, method)
+    if result.margin is None:
+        # The panorama has no runner-up
+        return result.heading, result.inlier_ratio
+    return result.heading, result.margin/result.num_matches if result.num_matches else 0.
+
+
+class OrientationService:
+    """
+    Serves the orientation of encoded frames to local clients, over a Unix socket or TCP.
+    Concurrent requests are gathered into micro-batches, taking one request of each client
+    in turn, and the frames of each batch are spread over a pool of worker threads, one
+    frame per thread, against a single warm OrientationFinder. The batches only decide
+    which requests go next and share out the workers fairly between the clients: each
+    frame is still estimated on its own, no computation is batched.
+    Each client has a bounded number of pending requests: above it, its connection
+    is not read, so the client is slowed down instead of the others.
+    """
+
+    def __init__(
+        self, orientation_finder:OrientationFinder, method=OrientMethod.RECOVER_POSE,
+        max_batch_size:int=8, batch_window:float=0.005, num_workers=None, max_pending:int=4
+    ) -> None:
+        """
+        :param orientation_finder: OrientationFinder with the references of the venue.
+        :param method: Method in which to estimate the orientation.
+        :param max_batch_size: Maximum number of requests in a batch.
+        :param batch_window: Maximum time, in seconds, that the first request of a batch
+        waits for others.
+        :param num_workers: Number of worker threads. If None, the executor default is used.
+        :param max_pending: Maximum number of pending requests of each client.
+        """
+        assert max_batch_size >= 1
+        assert batch_window >= 0
+        assert max_pending >= 1
+        self.orientation_finder = orientation_finder
+        self.method = method
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        # Same default as ThreadPoolExecutor
+        self.num_workers = num_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.executor = ThreadPoolExecutor(self.num_workers)
+
+        # Queue of requests of each connected client
+        self.client_queues = []
+        self.next_client = 0
+        self.server = None
+        self.batcher = None
+
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def estimate(self, payload:bytes) -> Estimate:
+        """
+        Decodes a frame and estimates its orientation, reporting a failure instead of raising it.
+        """
+        try:
+            img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_ANYCOLOR)
+            if img is None:
+                raise ValueError("The frame could not be decoded")
+            heading, confidence = estimate_orientation(self.orientation_finder, img, self.method)
+            return Estimate(float(heading), float(confidence), None)
+        except Exception as error:
+            return Estimate(None, None, repr(error))
+
+    def take_batch(self):
+        """
+        Takes up to max_batch_size requests from the client queues, one of each client in turn.
+        """
+        batch = []
+        while len(batch) < self.max_batch_size:
+            nonempty = [queue for queue in self.client_queues if not queue.empty()]
+            if not nonempty:
+                break
+            for i in range(len(self.client_queues)):
+                queue = self.client_queues[(self.next_client + i)%len(self.client_queues)]
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    self.next_client = (self.next_client + i + 1)%len(self.client_queues)
+                    break
+        return batch
+
+    async def collect_batch(self):
+        """
+        Waits for a request and then for up to batch_window for others to join its batch.
+        """
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            self.new_request.clear()
+            batch += self.take_batch()
+            if batch and deadline is None:
+                deadline = loop.time() + self.batch_window
+            if len(batch) >= self.max_batch_size or (batch and loop.time() >= deadline):
+                return batch
+            timeout = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(self.new_request.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self, payload:bytes, future):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, self.estimate, payload)
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.slots.release()
+
+    async def run_batcher(self):
+        while True:
+            batch = await self.collect_batch()
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            for payload, future in batch:
+                # At most one frame per worker is in flight. While they are all busy, the
+                # requests wait in the client queues and the next batch grows
+                await self.slots.acquire()
+                asyncio.create_task(self.dispatch(payload, future))
+
+    async def handle_client(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        responses = asyncio.Queue()
+        pending = asyncio.Semaphore(self.max_pending)
+        self.client_queues.append(queue)
+
+        async def write_responses():
+            while True:
+                item = await responses.get()
+                if item is None:
+                    break
+                request_id, future = item
+                estimate = await future
+                response = {"id": request_id, **estimate._asdict()}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+
+        response_writer = asyncio.create_task(write_responses())
+        try:
+            while True:
+                header = await reader.readexactly(REQUEST_HEADER.size)
+                request_id, size = REQUEST_HEADER.unpack(header)
+                payload = await reader.readexactly(size)
+                # Blocks while the client has max_pending requests in flight,
+                # so its connection is not read until one of them is done
+                await pending.acquire()
+                future = loop.create_future()
+                future.add_done_callback(lambda _: pending.release())
+                responses.put_nowait((request_id, future))
+                queue.put_nowait((payload, future))
+                self.new_request.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.client_queues.remove(queue)
+            self.next_client = 0
+            # The requests that were not batched yet are dropped
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                future.set_result(Estimate(None, None, "The client disconnected"))
+            responses.put_nowait(None)
+            try:
+                await response_writer
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def start(self, path=None, host="127.0.0.1", port=8765):
+        """
+        Starts listening, on a Unix socket if a path is given and on TCP otherwise.
+        :param path: Path of the Unix socket.
+        :param host: Host of the TCP socket.
+        :param port: Port of the TCP socket.
+        """
+        self.new_request = asyncio.Event()
+        self.slots = asyncio.Semaphore(self.num_workers)
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_client, path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.batcher = asyncio.create_task(self.run_batcher())
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def serve_forever(self, path=None, host="127.0.0.1", port=8765):
+        await self.start(path, host, port)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+
+class OrientationClient:
+    """
+    Blocking client of an OrientationService.
+    Requests can be sent ahead of their responses, which arrive in the same order.
+    """
+
+    def __init__(self, path=None, host="127.0.0.1", port=8765) -> None:
+        """
+        :param path: Path of the Unix socket. If None, TCP is used.
+        :param host: Host of the TCP socket.
+        :param port: Port of the TCP socket.
+        """
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(str(path))
+        else:
+            self.socket = socket.create_connection((host, port))
+        self.file = self.socket.makefile("rb")
+        self.next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def send(self, img, ext=".png") -> int:
+        """
+        Sends a frame without waiting for its response.
+        :param img: Image, or bytes of an already encoded image.
+        :param ext: Encoding of the image, when it is not encoded yet.
+        :return: Id of the request.
+        """
+        if isinstance(img, np.ndarray):
+            ok, img = cv2.imencode(ext, img)
+            assert ok, "The frame could not be encoded"
+        payload = bytes(img)
+        request_id = self.next_id
+        self.next_id += 1
+        self.socket.sendall(REQUEST_HEADER.pack(request_id, len(payload)) + payload)
+        return request_id
+
+    def receive(self):
+        """
+        Waits for the response of the oldest request without response.
+        :return: Id of the request and its Estimate.
+        """
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The service closed the connection")
+        response = json.loads(line)
+        return response["id"], Estimate(response["heading"], response["confidence"], response["error"])
+
+    def query(self, img, ext=".png") -> Estimate:
+        """
+        Sends a frame and waits for its Estimate.
+        """
+        self.send(img, ext)
+        return self.receive()[1]
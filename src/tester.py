@@ -5,11 +5,22 @@ import numpy as np
 import cv2
 
 from src.params import VisionParams
-from src.utils import build_intrinsic_mtx, get_angle_diff
+from src.utils import build_intrinsic_mtx, get_angle_diffs
+from src.dataset import parse_file_name
+from src.reference_compiler import compile_reference_db
 from src.orientation_finder import OrientationFinder, OrientMethod
+from src.reference_db import (
+    MANIFEST_FILE, reference_db_path, build_reference_db, load_orientation_finder
+)
 
 class Tester:
     dataset_path = Path("./dataset/")
+    # Default location of the pre-decoded dataset, see src.dataset.DatasetCache
+    dataset_cache_path = Path("./dataset_cache/")
+    # Default location of the extracted frame features, see src.query_cache.QueryFeatureCache
+    feature_cache_path = Path("./feature_cache/")
+    # Root of the compiled reference databases when no reference_db is given
+    compiled_db_path = Path("./compiled_refs/")
     sim_folders = [
         "jbhcentral", "kiara", "paul_lobe_haus",
         "sepulchral", "shangai", "stadium", "ulm"
@@ -23,16 +34,314 @@ class Tester:
     intrinsic_mtx = build_intrinsic_mtx(fx, fy, cx, cy)
 
     def __init__(
-        self, params:VisionParams, orient_method:OrientMethod,
-        ref_angles:set(), use_sim:bool, train_test:str
+        self, params:VisionParams, orient_method,
+        ref_angles:set(), use_sim:bool, train_test:str, merged_index:bool=False,
+        reference_db=None, num_coarse_refs=None, profiler=None, num_warmup:int=0,
+        preprocessor=None, descriptor_budget=None, dataset=None, feature_cache=None
     ):
+        """
+        :param orient_method: OrientMethod, or list of OrientMethod evaluated together
+        from a single extraction and matching of each image, see evaluate_methods.
+        :param reference_db: Root folder of the reference databases. If given, the reference
+        features are loaded from there, and only extracted when the database does not exist.
+        :param num_coarse_refs: If given, each image is only matched against this number of
+        references, the nearest by global signature.
+        :param profiler: Optional src.profiler.StageProfiler that records the time of each stage.
+        :param num_warmup: Number of images of each folder run once, untimed, before the evaluation.
+        :param preprocessor: Optional src.preprocess.Preprocessor applied before the feature extraction.
+        :param descriptor_budget: If given, each reference is pruned to this number of its most
+        discriminative descriptors, scored on the train split of its background. The pruned
+        references are compiled once into a reference database, see compile_reference_db.
+        Only the test split can then be evaluated.
+        :param dataset: Optional src.dataset.IndexedDataset, such as a DatasetCache, with the
+        decoded images. The images are then selected by index instead of decoding the PNGs.
+        :param feature_cache: Optional src.query_cache.QueryFeatureCache. Share it between
+        Testers that only differ on the references or on the matching and pose parameters,
+        so the features of each image are only extracted once. The measured times include
+        the extraction time stored with the features, so they stay comparable.
+        """
+        assert descriptor_budget is None or train_test == "test", (
+            "The descriptors are chosen on the train split, so evaluate on the test split"
+        )
         self.params = params
         self.orient_method = orient_method
         self.ref_angles = ref_angles
         self.use_sim = use_sim
         self.test_train = train_test
-    
+        self.merged_index = merged_index
+        self.reference_db = reference_db
+        self.num_coarse_refs = num_coarse_refs
+        self.profiler = profiler
+        self.num_warmup = num_warmup
+        self.preprocessor = preprocessor
+        self.descriptor_budget = descriptor_budget
+        self.dataset = dataset
+        self.feature_cache = feature_cache
+        self.fails = []
+
+    def load_imgs(self, folder, keep):
+        """
+        Returns the images of a background folder that pass a filter, in file name order.
+        With a dataset, they are selected by index and not copied. Otherwise the PNGs are decoded.
+        :param folder: Name of the background folder.
+        :param keep: Function of the case, angle and split of an image that tells whether to keep it.
+        :return: Lists with the images, their angles and their cases.
+        """
+        imgs, angles, cases = [], [], []
+        if self.dataset is not None:
+            for i in self.dataset.select(folder):
+                img_case, img_angle = self.dataset.cases[i], int(self.dataset.angles[i])
+                if keep(img_case, img_angle, self.dataset.splits[i]):
+                    imgs.append(self.dataset.image(i))
+                    angles.append(img_angle)
+                    cases.append(img_case)
+            return imgs, angles, cases
+        for file in sorted((self.dataset_path / folder).glob("*.png")):
+            img_case, img_angle, img_test_train = parse_file_name(file)
+            if keep(img_case, img_angle, img_test_train):
+                imgs.append(cv2.imread(str(file), cv2.IMREAD_ANYCOLOR))
+                angles.append(img_angle)
+                cases.append(img_case)
+        return imgs, angles, cases
+
+    def load_orientation_finder(self, folder):
+        """
+        Returns the Orientation Finder for a background folder, with the compiled
+        references when there is a descriptor budget.
+        :param folder: Name of the background folder.
+        :return: OrientationFinder
+        """
+        if self.descriptor_budget is None:
+            return self.load_full_orientation_finder(folder)
+        orientation_finder = load_orientation_finder(
+            self.compile_reference_db(folder), self.params, self.intrinsic_mtx, None,
+            self.merged_index, self.num_coarse_refs, self.preprocessor
+        )
+        orientation_finder.feature_cache = self.feature_cache
+        return orientation_finder
+
+    def load_full_orientation_finder(self, folder):
+        """
+        Returns the Orientation Finder for a background folder, with all the reference descriptors.
+        :param folder: Name of the background folder.
+        :return: OrientationFinder
+        """
+        if self.reference_db is None:
+            ref_imgs, ref_angles, _ = self.load_imgs(
+                folder, lambda case, angle, split: case == "ref" and angle in self.ref_angles
+            )
+            return OrientationFinder(
+                ref_imgs, ref_angles, self.params, self.intrinsic_mtx, self.merged_index,
+                self.num_coarse_refs, self.preprocessor, feature_cache=self.feature_cache
+            )
+        db_path = reference_db_path(self.reference_db, folder, self.params, self.preprocessor)
+        if not (db_path / MANIFEST_FILE).exists():
+            all_ref_imgs, all_ref_angles, _ = self.load_imgs(folder, lambda case, angle, split: case == "ref")
+            build_reference_db(
+                db_path, all_ref_imgs, all_ref_angles, self.params, self.preprocessor
+            )
+        orientation_finder = load_orientation_finder(
+            db_path, self.params, self.intrinsic_mtx, self.ref_angles, self.merged_index,
+            self.num_coarse_refs, self.preprocessor
+        )
+        orientation_finder.feature_cache = self.feature_cache
+        return orientation_finder
+
+    def compile_reference_db(self, folder, overwrite:bool=False):
+        """
+        Prunes the references to the descriptor budget, scoring them on the train split,
+        and saves them as a reference database, keyed by the budget and the reference angles.
+        The reference images themselves are not used for scoring.
+        :param folder: Name of the background folder.
+        :param overwrite: If True, the database is compiled again even if it exists.
+        :return: Path of the compiled database.
+        """
+        db_path = reference_db_path(
+            self.compiled_db_path if self.reference_db is None else self.reference_db,
+            folder, self.params, self.preprocessor, self.descriptor_budget, self.ref_angles
+        )
+        if overwrite or not (db_path / MANIFEST_FILE).exists():
+            train_imgs, train_angles, _ = self.load_imgs(
+                folder, lambda case, angle, split: (
+                    split == "train" and not (case == "ref" and angle in self.ref_angles)
+                )
+            )
+            compile_reference_db(
+                db_path, self.load_full_orientation_finder(folder), train_imgs, train_angles,
+                self.descriptor_budget
+            )
+        return db_path
+
+    def load_folders(self):
+        """
+        Yields the Orientation Finder and the test or train images of each background folder.
+        :return: Generator of the folder name, OrientationFinder, images, their angles and cases.
+        """
+        folders = self.sim_folders if self.use_sim else ["irl"]
+        for folder in folders:
+            imgs, angles, test_cases = self.load_imgs(
+                folder, lambda case, angle, split: split == self.test_train
+            )
+            orientation_finder = self.load_orientation_finder(folder)
+            yield folder, orientation_finder, imgs, angles, test_cases
+
+    def evaluate(self, orientation_finder, imgs, angles, test_cases, img_features=None):
+        """
+        Estimates the orientation of each image and measures the error and time.
+        The failed images are added to self.fails.
+        :param orientation_finder: OrientationFinder with the references of the images' background.
+        :param imgs: List with the images. Unused when img_features is given.
+        :param angles: List with the true angle of each image.
+        :param test_cases: List with the case of each image.
+        :param img_features: Optional list with already extracted features of each image,
+        as tuples (points, descriptors, extraction time in seconds). The extraction time
+        is added to the measured time, so the times stay comparable. Otherwise, with a
+        feature cache, the features are taken from it, see OrientationFinder.timed_cached_features.
+        :return: Lists with the times in seconds and the absolute errors in degrees.
+        """
+        for i in range(min(self.num_warmup, len(angles))):
+            try:
+                if img_features is None:
+                    orientation_finder.calc_orientation(imgs[i], self.orient_method)
+                else:
+                    orientation_finder.calc_orientation_features(
+                        *img_features[i][:2], self.orient_method
+                    )
+            except:
+                pass
+        orientation_finder.profiler = self.profiler
+        times = []
+        true_angles = []
+        estimated_angles = []
+        for i in range(len(angles)):
+            try:
+                if img_features is None and self.feature_cache is None:
+                    start_time = time.perf_counter()
+                    angle = orientation_finder.calc_orientation(imgs[i], self.orient_method)
+                    extraction_time = 0.
+                else:
+                    if img_features is not None:
+                        img_pts, img_descriptors, extraction_time = img_features[i]
+                    else:
+                        img_pts, img_descriptors, extraction_time = (
+                            orientation_finder.timed_cached_features(imgs[i])
+                        )
+                    start_time = time.perf_counter()
+                    angle = orientation_finder.calc_orientation_features(
+                        img_pts, img_descriptors, self.orient_method
+                    )
+                end_time = time.perf_counter()
+                times.append(end_time - start_time + extraction_time)
+                true_angles.append(angles[i])
+                estimated_angles.append(angle)
+            except:
+                self.fails.append(f"{test_cases[i]}_{angles[i]}")
+        errors = np.abs(get_angle_diffs(true_angles, estimated_angles))
+        return times, list(errors)
+
+    def evaluate_methods(self, orientation_finder, imgs, angles, test_cases, methods):
+        """
+        Estimates the orientation of each image with several methods, extracting and
+        matching its features once. Only the final step of each method is run apart.
+        The failed images are added to self.fails, under each method that failed.
+        :param orientation_finder: OrientationFinder with the references of the images' background.
+        :param imgs: List with the images.
+        :param angles: List with the true angle of each image.
+        :param test_cases: List with the case of each image.
+        :param methods: List of OrientMethod.
+        :return: Lists with the extraction and matching times in seconds, and dicts by method
+        with the lists of times of the final step, in seconds, and absolute errors, in degrees.
+        """
+        # The panorama does not use the matches against each reference
+        match = any(method != OrientMethod.PANORAMA for method in methods)
+
+        def shared_step(img):
+            if self.feature_cache is None:
+                start_time = time.perf_counter()
+                _, img_pts, img_descriptors = orientation_finder.detect(img)
+                extraction_time = time.perf_counter() - start_time
+            else:
+                img_pts, img_descriptors, extraction_time = orientation_finder.timed_cached_features(img)
+            start_time = time.perf_counter()
+            matches = None
+            if match:
+                matches = orientation_finder.match_references(
+                    img_descriptors, early_exit_matches=self.params.early_exit_matches
+                )
+            matching_time = time.perf_counter() - start_time
+            return (img_pts, img_descriptors, matches), extraction_time, matching_time
+
+        for i in range(min(self.num_warmup, len(angles))):
+            try:
+                features, _, _ = shared_step(imgs[i])
+                for method in methods:
+                    orientation_finder.calc_orientation_result_matches(*features, method)
+            except:
+                pass
+        orientation_finder.profiler = self.profiler
+        extraction_times = []
+        matching_times = []
+        tail_times = {method: [] for method in methods}
+        true_angles = {method: [] for method in methods}
+        estimated_angles = {method: [] for method in methods}
+        for i in range(len(angles)):
+            try:
+                features, extraction_time, matching_time = shared_step(imgs[i])
+                extraction_times.append(extraction_time)
+                matching_times.append(matching_time)
+            except:
+                for method in methods:
+                    self.fails[method].append(f"{test_cases[i]}_{angles[i]}")
+                continue
+            for method in methods:
+                try:
+                    start_time = time.perf_counter()
+                    result = orientation_finder.calc_orientation_result_matches(*features, method)
+                    tail_times[method].append(time.perf_counter() - start_time)
+                    true_angles[method].append(angles[i])
+                    estimated_angles[method].append(result.heading)
+                except:
+                    # Keeps the tail times aligned with the extraction and matching times
+                    tail_times[method].append(np.nan)
+                    self.fails[method].append(f"{test_cases[i]}_{angles[i]}")
+        errors = {
+            method: list(np.abs(get_angle_diffs(true_angles[method], estimated_angles[method])))
+            for method in methods
+        }
+        return extraction_times, matching_times, tail_times, errors
+
+    def save_results(self, save_tag, times, errors, angles, cases, backgrounds):
+        """
+        Saves the results of an evaluation, one text file per list with one value per line.
+        """
+        with open(f"times_{save_tag}.txt", "w") as f:
+            f.writelines(map(lambda x: f"{x}\n", times))
+        with open(f"errors_{save_tag}.txt", "w") as f:
+            f.writelines(map(lambda x: f"{x}\n", errors))
+        with open(f"angles_{save_tag}.txt", "w") as f:
+            f.writelines(map(lambda x: f"{x}\n", angles))
+        with open(f"cases_{save_tag}.txt", "w") as f:
+            f.writelines(map(lambda x: f"{x}\n", cases))
+        with open(f"backgrounds_{save_tag}.txt", "w") as f:
+            f.writelines(map(lambda x: f"{x}\n", backgrounds))
+
     def performance(self, save_results:bool=False, save_tag:str=""):
+        """
+        Evaluates the orientation method on the test or train images of every background.
+        With a list of methods, the features of each image are extracted and matched once
+        for all of them. The times are in ms, the errors in degrees.
+        :param save_results: If True, the times, errors, angles, cases and backgrounds are
+        saved to text files. With a list of methods, the method name, such as "recoverpose",
+        is appended to the save tag.
+        :param save_tag: Suffix of the saved files.
+        :return: Mean and standard deviation of the times and of the errors. With a list of
+        methods, a dict of them by method, where the time of a method is the time of the stages
+        it uses, as if it ran alone. The times of the stages are kept in extraction_times,
+        matching_times and tail_times, by method, and total_times is the sum of all of them.
+        """
+        methods = self.orient_method if isinstance(self.orient_method, (list, tuple)) else None
+        if methods is not None:
+            return self.performance_methods(methods, save_results, save_tag)
         times = []
         errors = []
 
@@ -42,62 +351,76 @@ class Tester:
 
         self.fails = []
 
-        folders = self.sim_folders if self.use_sim else ["irl"]
-        for folder in folders:
-            path = self.dataset_path / folder
-
-            ref_imgs = []
-            ref_angles = []
-
-            imgs = []
-            angles = []
-            test_cases = []
-
-            for file in path.glob("*.png"):
-                split_name = file.name.split(".")
-                split_name = split_name[0].split("_")
-                img_case = split_name[0]
-                img_angle = int(split_name[1])
-                img_test_train = split_name[2]
-                img = cv2.imread(str(file), cv2.IMREAD_ANYCOLOR)
-                if img_case == "ref" and (img_angle in self.ref_angles):
-                    ref_imgs.append(img)
-                    ref_angles.append(img_angle)
-                if img_test_train == self.test_train:
-                    imgs.append(img)
-                    angles.append(img_angle)
-                    test_cases.append(img_case)
-            
-            orientation_finder = OrientationFinder(
-                ref_imgs, ref_angles, self.params, self.intrinsic_mtx
-            )
-
+        for folder, orientation_finder, imgs, angles, test_cases in self.load_folders():
             global_angles.extend(angles)
             global_cases.extend(test_cases)
             backgrounds.extend(len(imgs)*[folder])
 
-            for i in range(len(imgs)):
-                try:
-                    start_time = time.time()
-                    angle_diff = abs(get_angle_diff(
-                        angles[i],  orientation_finder.calc_orientation(imgs[i], self.orient_method)
-                    ))
-                    errors.append(angle_diff)
-                    end_time = time.time()
-                    times.append(end_time - start_time)
-                except:
-                    self.fails.append(f"{test_cases[i]}_{angles[i]}")
+            folder_times, folder_errors = self.evaluate(orientation_finder, imgs, angles, test_cases)
+            times.extend(folder_times)
+            errors.extend(folder_errors)
         times = 1000*np.array(times)
         errors = np.array(errors)
+        # Kept for reports that need more than the mean and standard deviation
+        self.times = times
+        self.errors = errors
         if save_results:
-            with open(f"times_{save_tag}.txt", "w") as f:
-                f.writelines(map(lambda x: f"{x}\n", times))
-            with open(f"errors_{save_tag}.txt", "w") as f:
-                f.writelines(map(lambda x: f"{x}\n", errors))
-            with open(f"angles_{save_tag}.txt", "w") as f:
-                f.writelines(map(lambda x: f"{x}\n", global_angles))
-            with open(f"cases_{save_tag}.txt", "w") as f:
-                f.writelines(map(lambda x: f"{x}\n", global_cases))
-            with open(f"backgrounds_{save_tag}.txt", "w") as f:
-                f.writelines(map(lambda x: f"{x}\n", backgrounds))
+            self.save_results(save_tag, times, errors, global_angles, global_cases, backgrounds)
         return times.mean(), times.std(), errors.mean(), errors.std()
+
+    def performance_methods(self, methods, save_results:bool=False, save_tag:str=""):
+        """
+        Evaluates several orientation methods at once, see performance.
+        """
+        extraction_times = []
+        matching_times = []
+        tail_times = {method: [] for method in methods}
+        errors = {method: [] for method in methods}
+
+        global_angles = []
+        global_cases = []
+        backgrounds = []
+
+        self.fails = {method: [] for method in methods}
+
+        for folder, orientation_finder, imgs, angles, test_cases in self.load_folders():
+            global_angles.extend(angles)
+            global_cases.extend(test_cases)
+            backgrounds.extend(len(imgs)*[folder])
+
+            folder_extraction_times, folder_matching_times, folder_tail_times, folder_errors = (
+                self.evaluate_methods(orientation_finder, imgs, angles, test_cases, methods)
+            )
+            extraction_times.extend(folder_extraction_times)
+            matching_times.extend(folder_matching_times)
+            for method in methods:
+                tail_times[method].extend(folder_tail_times[method])
+                errors[method].extend(folder_errors[method])
+        self.extraction_times = 1000*np.array(extraction_times)
+        self.matching_times = 1000*np.array(matching_times)
+        self.tail_times = {method: 1000*np.array(tail_times[method]) for method in methods}
+        self.total_times = (
+            self.extraction_times + self.matching_times
+            + np.nansum(list(self.tail_times.values()), axis=0)
+        )
+        self.times = {}
+        self.errors = {}
+        results = {}
+        for method in methods:
+            tail = self.tail_times[method]
+            times = self.extraction_times + tail
+            if method != OrientMethod.PANORAMA:
+                times += self.matching_times
+            times = times[~np.isnan(tail)]
+            self.times[method] = times
+            self.errors[method] = np.array(errors[method])
+            results[method] = (
+                times.mean(), times.std(), self.errors[method].mean(), self.errors[method].std()
+            )
+            if save_results:
+                method_tag = method.name.lower().replace("_", "")
+                self.save_results(
+                    f"{save_tag}_{method_tag}" if save_tag else method_tag, times, self.errors[method],
+                    global_angles, global_cases, backgrounds
+                )
+        return results
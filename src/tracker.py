@@ -0,0 +1,108 @@
+import numpy as np
+
+from src.orientation_finder import OrientationFinder
+from src.utils import get_angle_diffs
+
+
+class OrientationTracker:
+    """
+    Tracks the orientation over a stream of frames from a smoothly turning robot.
+    Each frame is first matched only against the references nearest to the previous
+    heading, and all references are searched only when that match is weak.
+    Optionally, the rotation is estimated against the previous frame instead,
+    re-anchoring on the references every few frames to bound the drift.
+    """
+
+    def __init__(
+        self, orientation_finder:OrientationFinder, num_near_refs:int=2,
+        min_inliers:int=30, frame_to_frame:bool=False, anchor_interval:int=10
+    ) -> None:
+        """
+        :param orientation_finder: Orientation Finder with the references of the field.
+        :param num_near_refs: Number of references nearest to the previous heading that are matched.
+        :param min_inliers: Minimum number of recoverPose inliers to trust an estimate.
+        Below it, all references are searched.
+        :param frame_to_frame: If True, the rotation is estimated against the previous frame.
+        :param anchor_interval: Maximum number of consecutive frame to frame estimates
+        before matching against the references again.
+        """
+        self.orientation_finder = orientation_finder
+        self.num_near_refs = num_near_refs
+        self.min_inliers = min_inliers
+        self.frame_to_frame = frame_to_frame
+        self.anchor_interval = anchor_interval
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous frames, so the next one is searched against all references.
+        """
+        self.heading = None
+        self.num_inliers = 0
+        self.prev_frame = None
+        self.frames_since_anchor = 0
+        self.num_full_searches = 0
+
+    def near_ref_ids(self, heading):
+        """
+        Returns the positions of the references nearest to the heading.
+        """
+        ref_angles = [ref.angle for ref in self.orientation_finder.references]
+        diffs = np.abs(get_angle_diffs(heading, ref_angles))
+        return np.argsort(diffs, kind='stable')[:self.num_near_refs].tolist()
+
+    def locate(self, img_pts, img_descriptors, ref_ids=None):
+        """
+        Estimates the orientation against the references.
+        :param ref_ids: Positions of the references to match. All references if None.
+        :return: Orientation angle in degrees and number of inliers.
+        """
+        orientation_finder = self.orientation_finder
+        best_match = orientation_finder.get_best_match(
+            orientation_finder.match_references(img_descriptors, ref_ids)[0]
+        )
+        return orientation_finder.recover_pose(best_match, img_pts)
+
+    def update(self, img):
+        """
+        Estimates the orientation of the next frame. Can be used as a camera callback.
+        :param img: Frame.
+        :return: Orientation angle in degrees. Limited to [0, 360[
+        """
+        orientation_finder = self.orientation_finder
+        _, img_pts, img_descriptors = orientation_finder.detect(img)
+
+        angle, num_inliers = None, 0
+        if (
+            self.frame_to_frame and self.prev_frame is not None
+            and self.frames_since_anchor < self.anchor_interval
+        ):
+            prev_matches = orientation_finder.match_reference(self.prev_frame, img_descriptors)
+            angle, num_inliers = orientation_finder.recover_pose(prev_matches, img_pts)
+            self.frames_since_anchor += 1
+        if num_inliers < self.min_inliers and self.heading is not None:
+            angle, num_inliers = self.locate(
+                img_pts, img_descriptors, self.near_ref_ids(self.heading)
+            )
+            self.frames_since_anchor = 0
+        if num_inliers < self.min_inliers:
+            angle, num_inliers = self.locate(img_pts, img_descriptors)
+            self.frames_since_anchor = 0
+            self.num_full_searches += 1
+
+        self.heading = angle
+        self.num_inliers = num_inliers
+        if self.frame_to_frame:
+            self.prev_frame = OrientationFinder.Reference(
+                None, angle, None, img_descriptors, img_pts
+            )
+        return angle
+
+    def track(self, frames):
+        """
+        Estimates the orientation of each frame of a stream.
+        :param frames: Iterable with the frames, such as a generator reading a camera.
+        :return: Generator with the orientation angle of each frame.
+        """
+        for img in frames:
+            yield self.update(img)
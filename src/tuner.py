@@ -0,0 +1,122 @@
+from contextlib import ExitStack
+from math import ceil
+import random
+
+from src.dataset import IndexedDataset
+from src.search import ParamSearch, SearchResult, result_cost
+
+
+def interleave(groups, rng:random.Random):
+    """
+    Merges lists taking one item of each in turn, in a random order of the lists,
+    so any prefix of the result is spread over all of them.
+    """
+    groups = [list(group) for group in groups]
+    rng.shuffle(groups)
+    merged = []
+    for i in range(max((len(group) for group in groups), default=0)):
+        merged.extend(group[i] for group in groups if i < len(group))
+    return merged
+
+
+class SuccessiveHalving(ParamSearch):
+    """
+    Tuner that evaluates many candidates on small subsets of the dataset
+    and only gives the full dataset to the most promising ones.
+    At each rung, the candidates are scored with src.utils.cost on a growing
+    subset of the images, and only the best 1/eta of them go on.
+    """
+
+    # Width of the angle strata of the rung subsets, in degrees
+    angle_stratum = 90
+
+    def rung_order(self, dataset:IndexedDataset):
+        """
+        Returns the order in which the images enter the rungs: a seeded permutation of the
+        split, stratified by folder, then by case, then by angle, so each rung subset, a prefix
+        of it, is spread over all of them. The references at ref_angles are left out, since
+        they are matched against themselves and their error says nothing about the candidate.
+        :return: List with the image indices.
+        """
+        rng = random.Random(f"{self.seed}:rungs")
+        folder_orders = []
+        for folder in self.folders:
+            strata = {}
+            for i in dataset.select(folder, split=self.split):
+                case, angle = dataset.cases[i], int(dataset.angles[i])
+                if case == "ref" and angle in self.ref_angles:
+                    continue
+                strata.setdefault(case, {}).setdefault(angle//self.angle_stratum, []).append(int(i))
+            case_orders = []
+            for angle_strata in strata.values():
+                for stratum in angle_strata.values():
+                    rng.shuffle(stratum)
+                case_orders.append(interleave(angle_strata.values(), rng))
+            folder_orders.append(interleave(case_orders, rng))
+        return interleave(folder_orders, rng)
+
+    def rung_budget(self, rung:int, num_rungs:int, eta:int, dataset:IndexedDataset, order):
+        """
+        Returns the subset of the dataset evaluated at a rung, a prefix of the rung order.
+        The number of images grows by eta at each rung, so each subset contains the
+        previous ones, and the last rung evaluates the full dataset.
+        :param dataset: Dataset with the images.
+        :param order: Image indices in the order returned by rung_order.
+        :return: Folders and indices of the images, or None for the full dataset.
+        """
+        if rung == num_rungs - 1:
+            return self.folders, None
+        fraction = eta**(rung - num_rungs + 1)
+        indices = order[:max(1, ceil(fraction*len(order)))]
+        rung_folders = set(dataset.backgrounds[indices])
+        return [folder for folder in self.folders if folder in rung_folders], indices
+
+    def rung_log_path(self, rung:int, num_rungs:int, eta:int):
+        """
+        Returns the log of the evaluations of a rung that is not the last one,
+        next to the log of the search and named after the rung and its budget, since the
+        subsets of the rungs depend on them. None if the search has no log.
+        """
+        if self.log_path is None:
+            return None
+        return self.log_path.with_name(
+            f"{self.log_path.stem}_rung{rung}of{num_rungs}_eta{eta}{self.log_path.suffix}"
+        )
+
+    def run(self, num_candidates:int, eta:int=3, num_rungs:int=3) -> SearchResult:
+        """
+        Runs the successive halving.
+        The evaluations on the full dataset are written to the log and those of the other
+        rungs to a log per rung, see rung_log_path. The candidates already in the log of a rung
+        are not evaluated again, so running it again resumes it.
+        :param num_candidates: Number of candidates of the first rung.
+        :param eta: Ratio between the budget of consecutive rungs.
+        Only the best 1/eta of the candidates go to the next rung.
+        :param num_rungs: Number of rungs.
+        :return: SearchResult with the lowest cost on the full dataset.
+        """
+        dataset = self.open_dataset()
+        order = self.rung_order(dataset)
+        survivors = list(range(num_candidates))
+        try:
+            with ExitStack() as stack:
+                executor = None
+                for rung in range(num_rungs):
+                    last_rung = rung == num_rungs - 1
+                    log_path = self.log_path if last_rung else self.rung_log_path(rung, num_rungs, eta)
+                    logged = self.load_log(log_path)
+                    results = {i: logged[i] for i in survivors if i in logged}
+                    pending = [i for i in survivors if i not in results]
+                    if pending:
+                        if executor is None:
+                            executor = stack.enter_context(self.open_pool(dataset))
+                        folders, indices = self.rung_budget(rung, num_rungs, eta, dataset, order)
+                        results.update(self.evaluate_candidates(
+                            executor, pending, folders, indices=indices, log_path=log_path
+                        ))
+                    survivors = sorted(survivors, key=lambda i: result_cost(results[i]))
+                    if not last_rung:
+                        survivors = survivors[:max(1, len(survivors)//eta)]
+        finally:
+            dataset.close()
+        return results[survivors[0]]
@@ -9,15 +9,8 @@ def get_angle_diff(angle1, angle2):
     :param angle2: second angle in degrees.
     :return: angle1 - angle2, limited to ]-180, 180]
     """
-    phi = angle2 - angle1
-    # Calculating the sign
-    sign = 1
-    if not ((-180 <= phi <= 0) or (180 <= phi <= 360)):
-        sign = -1
-    # Limiting phi
-    phi = abs(phi)%360
-    phi = 360 - phi if phi > 180 else phi
-    return sign*phi
+    # Same wrap as get_angle_diffs, the floored modulo maps any difference into [0, 360[
+    return 180. - (180. - (angle1 - angle2))%360
 
 
 def weighted_avg(values, weigths):
@@ -33,6 +26,65 @@ def weighted_avg(values, weigths):
     return avg
 
 
+def get_angle_diffs(angles1, angles2):
+    """
+    Vectorized version of get_angle_diff.
+    :param angles1: array of first angles in degrees.
+    :param angles2: array of second angles in degrees, broadcastable with angles1.
+    :return: np.array with angles1 - angles2, limited to ]-180, 180]
+    """
+    diffs = np.asarray(angles1, dtype=float) - np.asarray(angles2, dtype=float)
+    return 180. - np.mod(180. - diffs, 360.)
+
+
+def weighted_circular_avg(angles, weights=None, axis=-1):
+    """
+    Calculates the weighted circular mean of the angles via their sines and cosines.
+    Unlike weighted_avg, it is not affected by the wrap around at ±180.
+    :param angles: array of angles in degrees.
+    :param weights: array of weights broadcastable with angles. Uniform if None.
+    :param axis: axis along which the mean is taken.
+    :return: Mean angle in degrees, limited to ]-180, 180]
+    """
+    angles = np.deg2rad(np.asarray(angles, dtype=float))
+    weights = np.ones_like(angles) if weights is None else np.asarray(weights, dtype=float)
+    sin_sum = np.sum(weights*np.sin(angles), axis=axis)
+    cos_sum = np.sum(weights*np.cos(angles), axis=axis)
+    return get_angle_diffs(np.rad2deg(np.arctan2(sin_sum, cos_sum)), 0.)
+
+
+def circular_mean(angles, axis=None):
+    """
+    Calculates the circular mean of the angles.
+    :param angles: array of angles in degrees.
+    :param axis: axis along which the mean is taken. The flattened array if None.
+    :return: Mean angle in degrees, limited to ]-180, 180]
+    """
+    angles = np.asarray(angles, dtype=float)
+    if axis is None:
+        angles = angles.ravel()
+        axis = -1
+    return weighted_circular_avg(angles, axis=axis)
+
+
+def circular_std(angles, axis=None):
+    """
+    Calculates the circular standard deviation of the angles, sqrt(-2 ln R),
+    with R the mean resultant length.
+    For concentrated angles it is close to the linear standard deviation.
+    :param angles: array of angles in degrees.
+    :param axis: axis along which the deviation is taken. The flattened array if None.
+    :return: Standard deviation in degrees.
+    """
+    angles = np.deg2rad(np.asarray(angles, dtype=float))
+    if axis is None:
+        angles = angles.ravel()
+        axis = -1
+    resultant_len = np.hypot(np.mean(np.sin(angles), axis=axis), np.mean(np.cos(angles), axis=axis))
+    # Clipped so that a resultant length rounded above 1 does not give nan
+    return np.rad2deg(np.sqrt(-2*np.log(np.clip(resultant_len, 1e-300, 1.))))
+
+
 def build_intrinsic_mtx(fx, fy, cx, cy):
     """
     Returns the intrinsic matrix.
@@ -47,6 +99,23 @@ def build_intrinsic_mtx(fx, fy, cx, cy):
                      [0., 0., 1.]])
 
 
+def calc_bearing_angles(pts, intrinsic_mtx):
+    """
+    Calculates the bearing of image points, as the azimuth around the camera's vertical axis
+    and the elevation above its horizontal plane.
+    A rotation of the camera about its vertical axis adds the same angle to every azimuth
+    and keeps the elevations.
+    :param pts: (N, 2) np.array with the pixel coordinates.
+    :param intrinsic_mtx: Intrinsic matrix of the camera.
+    :return: np.arrays with the azimuths and the elevations in radians.
+    """
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    rays = np.hstack((pts, np.ones((len(pts), 1)))) @ np.linalg.inv(intrinsic_mtx).T
+    azimuths = np.arctan2(rays[:, 0], rays[:, 2])
+    elevations = np.arctan2(rays[:, 1], np.hypot(rays[:, 0], rays[:, 2]))
+    return azimuths, elevations
+
+
 def calc_euler_angles(rotation_mtx):
     """
     Calculates the Euler angles: yaw, pitch and roll.
@@ -65,6 +134,25 @@ def calc_euler_angles(rotation_mtx):
         roll = np.arctan2(-rotation_mtx[1][2], rotation_mtx[1][1])
     return np.rad2deg(yaw), np.rad2deg(pitch), np.rad2deg(roll)
 
+def calc_euler_angles_batch(rotation_mtxs):
+    """
+    Vectorized version of calc_euler_angles.
+    :param rotation_mtxs: array of rotation matrices with shape (N, 3, 3).
+    :return: np.array with shape (N, 3) with the Yaw, Pitch and Roll in degrees.
+    """
+    rotation_mtxs = np.asarray(rotation_mtxs, dtype=float)
+    sy = np.hypot(rotation_mtxs[:, 0, 0], rotation_mtxs[:, 1, 0])
+    singular = sy < 1e-6
+    yaw = np.where(singular, 0., np.arctan2(rotation_mtxs[:, 1, 0], rotation_mtxs[:, 0, 0]))
+    pitch = np.arctan2(-rotation_mtxs[:, 2, 0], sy)
+    roll = np.where(
+        singular,
+        np.arctan2(-rotation_mtxs[:, 1, 2], rotation_mtxs[:, 1, 1]),
+        np.arctan2(rotation_mtxs[:, 2, 1], rotation_mtxs[:, 2, 2])
+    )
+    return np.rad2deg(np.stack((yaw, pitch, roll), axis=-1))
+
+
 def cost(time_mean, time_std, error_mean, error_std):
     time_cost = time_mean + time_std if time_mean > 100 else 0
     error_cost = error_mean + error_std/2
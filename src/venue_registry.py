@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+from src.params import VisionParams
+from src.orientation_finder import OrientationFinder
+from src import reference_db
+
+
+class VenueRegistry:
+    """
+    Maps venue names to their references and builds each OrientationFinder on first use.
+    The built finders are kept in an LRU cache bounded by their resident bytes,
+    and the next venue can be prefetched in a background thread, so switching
+    venues does not stall the caller while the references are extracted.
+    """
+
+    def __init__(
+        self, params:VisionParams, intrinsic_mtx=None, max_bytes=None,
+        merged_index:bool=False, num_coarse_refs=None, preprocessor=None
+    ) -> None:
+        """
+        :param params: Vision parameters used by every venue.
+        :param intrinsic_mtx: Intrinsic matrix of the camera.
+        :param max_bytes: Budget of resident bytes of the finders kept in memory, see OrientationFinder.memory_usage.
+        The least recently used venues are evicted above it, except the one in use.
+        If None, no venue is evicted.
+        :param merged_index: If True, all references are matched with a single query.
+        :param num_coarse_refs: If given, only this number of references, the nearest by
+        global signature, are matched.
+        :param preprocessor: Optional src.preprocess.Preprocessor applied before the feature extraction.
+        """
+        self.params = params
+        self.intrinsic_mtx = intrinsic_mtx
+        self.max_bytes = max_bytes
+        self.merged_index = merged_index
+        self.num_coarse_refs = num_coarse_refs
+        self.preprocessor = preprocessor
+
+        self.builders = {}
+        # Incremented at each registration of a venue, to discard the builds of a previous builder
+        self.generations = {}
+        self.finders = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Waits for the pending prefetches and stops the background thread.
+        """
+        self.executor.shutdown(wait=True)
+
+    @property
+    def venues(self):
+        return list(self.builders)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Number of resident bytes of the loaded venues.
+        """
+        with self.lock:
+            return sum(finder.nbytes() for finder in self.finders.values())
+
+    def register(self, venue:str, builder):
+        """
+        Registers a venue.
+        :param venue: Name of the venue.
+        :param builder: Function without arguments that returns the OrientationFinder of the venue.
+        """
+        with self.lock:
+            self.builders[venue] = builder
+            # A stale finder of a re-registered venue must not be served, nor cached
+            # by a build of the previous builder that is still running
+            self.generations[venue] = self.generations.get(venue, 0) + 1
+            self.finders.pop(venue, None)
+            self.pending.pop(venue, None)
+
+    def register_images(self, venue:str, ref_imgs, ref_angles):
+        """
+        Registers a venue from its reference images.
+        :param venue: Name of the venue.
+        :param ref_imgs: List with the reference images.
+        :param ref_angles: List with the angles of each reference image, in the same order as the images.
+        """
+        self.register(venue, lambda: OrientationFinder(
+            ref_imgs, ref_angles, self.params, self.intrinsic_mtx, self.merged_index,
+            self.num_coarse_refs, self.preprocessor
+        ))
+
+    def register_db(self, venue:str, path, ref_angles=None):
+        """
+        Registers a venue from its reference database.
+        :param venue: Name of the venue.
+        :param path: Database folder, see src.reference_db.
+        :param ref_angles: Angles of the references to use. If None, all references are used.
+        """
+        self.register(venue, lambda: reference_db.load_orientation_finder(
+            path, self.params, self.intrinsic_mtx, ref_angles, self.merged_index,
+            self.num_coarse_refs, self.preprocessor
+        ))
+
+    def is_loaded(self, venue:str) -> bool:
+        with self.lock:
+            return venue in self.finders
+
+    def start_build(self, venue:str):
+        """
+        Returns the pending build of a venue, creating it if there is none.
+        Must be called holding the lock.
+        :return: Future of the build and, if it was just created, the arguments of build.
+        """
+        future = self.pending.get(venue)
+        if future is not None:
+            return future, None
+        future = self.pending[venue] = Future()
+        return future, (venue, future, self.generations[venue], self.builders[venue])
+
+    def build(self, venue:str, future:Future, generation:int, builder):
+        """
+        Builds the OrientationFinder of a venue, adds it to the cache and resolves its future.
+        The result is None when the venue was re-registered during the build.
+        :param venue: Name of the venue.
+        :param future: Future of the build, in the pending builds.
+        :param generation: Generation of the venue when the build started.
+        :param builder: Builder of the venue when the build started.
+        """
+        try:
+            orientation_finder = builder()
+        except BaseException as error:
+            with self.lock:
+                if self.pending.get(venue) is future:
+                    del self.pending[venue]
+            future.set_exception(error)
+            return
+        with self.lock:
+            if self.pending.get(venue) is future:
+                del self.pending[venue]
+            if self.generations[venue] != generation:
+                orientation_finder = None
+            else:
+                self.finders[venue] = orientation_finder
+                self.finders.move_to_end(venue)
+                self.evict(keep=venue)
+        future.set_result(orientation_finder)
+
+    def evict(self, keep:str):
+        """
+        Evicts the least recently used venues while above the memory budget.
+        Must be called holding the lock.
+        :param keep: Venue that is never evicted.
+        """
+        if self.max_bytes is None:
+            return
+        total = sum(finder.nbytes() for finder in self.finders.values())
+        for venue in list(self.finders):
+            if total <= self.max_bytes:
+                break
+            if venue == keep:
+                continue
+            total -= self.finders.pop(venue).nbytes()
+            self.evictions += 1
+
+    def prefetch(self, venue:str):
+        """
+        Builds the OrientationFinder of a venue in the background, if it is not loaded yet.
+        :param venue: Name of the venue.
+        :return: concurrent.futures.Future with the OrientationFinder, or None if already loaded.
+        The result of the future is None if the venue is re-registered during the build.
+        """
+        with self.lock:
+            assert venue in self.builders, f"Unknown venue: {venue}"
+            if venue in self.finders:
+                return None
+            future, build_args = self.start_build(venue)
+            if build_args is not None:
+                self.executor.submit(self.build, *build_args)
+            return future
+
+    def get(self, venue:str, block:bool=True):
+        """
+        Returns the OrientationFinder of a venue, building it if needed.
+        Concurrent calls for the same venue wait for a single build.
+        :param venue: Name of the venue.
+        :param block: If False and the venue is not loaded yet, its build is started in
+        the background and None is returned, so the caller can keep its previous finder.
+        :return: OrientationFinder, or None.
+        """
+        with self.lock:
+            assert venue in self.builders, f"Unknown venue: {venue}"
+            if venue in self.finders:
+                self.hits += 1
+                self.finders.move_to_end(venue)
+                return self.finders[venue]
+            self.misses += 1
+        if not block:
+            self.prefetch(venue)
+            return None
+        while True:
+            with self.lock:
+                if venue in self.finders:
+                    self.finders.move_to_end(venue)
+                    return self.finders[venue]
+                future, build_args = self.start_build(venue)
+            if build_args is not None:
+                # Built in the calling thread, so it does not queue behind the prefetches
+                self.build(*build_args)
+            orientation_finder = future.result()
+            # None when the venue was re-registered during the build, which is then redone
+            if orientation_finder is not None:
+                return orientation_finder
@@ -0,0 +1,56 @@
+import time
+
+import cv2
+import numpy as np
+
+from src.orientation_finder import OrientationFinder, OrientMethod
+from src.params import VisionParams
+from src.dataset import parse_file_name
+from src.tester import Tester
+from src.frame_ring import FrameRing, FileFrameProducer
+
+# Streams the test frames of a background through a shared memory ring buffer,
+# as the camera driver would, and estimates the orientation of the freshest frame.
+
+folder = "ulm"
+fps = 30
+num_frames = 60
+ref_angles = {45*i for i in range(8)}
+
+path = Tester.dataset_path / folder
+ref_imgs = []
+angles = []
+for file in sorted(path.glob("ref_*.png")):
+    _, img_angle, _ = parse_file_name(file)
+    if img_angle in ref_angles:
+        ref_imgs.append(cv2.imread(str(file), cv2.IMREAD_ANYCOLOR))
+        angles.append(img_angle)
+files = sorted(path.glob("*_test.png"))
+true_angles = [parse_file_name(file)[1] for file in files]
+
+# Best parameters found by random_search.py
+params = VisionParams(1230, 1.8847186328577767, 44, 18, 0.9827160798859101, 7)
+orientation_finder = OrientationFinder(ref_imgs, angles, params, Tester.intrinsic_mtx)
+
+with FrameRing.create_shared(ref_imgs[0].shape, capacity=8) as ring:
+    producer = FileFrameProducer(ring, files, fps, loop=True).start()
+    times = []
+    frame_id = -1
+    for _ in range(num_frames):
+        frame_id, img = ring.wait_next(frame_id)
+        start_time = time.perf_counter()
+        result = orientation_finder.calc_orientation_result(img, OrientMethod.RECOVER_POSE)
+        times.append(time.perf_counter() - start_time)
+        # The producer may have reused the slot while the frame was processed
+        if not ring.is_valid(frame_id):
+            print(f"Frame {frame_id} was overwritten while being processed")
+            continue
+        print(
+            f"Frame {frame_id}: {result.heading:.1f}º "
+            f"(true {true_angles[frame_id%len(files)]}º, {result.num_matches} matches)"
+        )
+    producer.stop()
+    del img
+
+times = 1000*np.array(times)
+print(f"Execution Time: {times.mean():.0f}±{times.std():.0f} ms per frame")